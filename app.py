@@ -1,44 +1,41 @@
 import os
 import json
 import base64
+import csv
+import bisect
+import functools
+import hashlib
+import importlib.util
+import itertools
 import random
 import re
+import string
+import sys
+import time
 import difflib
 from datetime import datetime, date
-from io import BytesIO
-from typing import Dict, Any, List, Tuple, Optional
+from io import BytesIO, StringIO
+from types import MappingProxyType
+from typing import Dict, Any, Iterator, List, Tuple, Optional
 
 import streamlit as st
 import yaml
 import pandas as pd
-import altair as alt
-from pypdf import PdfReader
 
 try:
-    from docx import Document  # python-docx
+    import orjson  # optional, recommended: much faster JSON parsing than stdlib json
 except ImportError:
-    Document = None
+    orjson = None
 
 try:
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.pagesizes import letter
+    import pyarrow as pa
+    import pyarrow.feather as feather
 except ImportError:
-    canvas = None
-    letter = None
+    pa = None
+    feather = None
 
-try:
-    import pytesseract
-    from pdf2image import convert_from_bytes
-    from PIL import Image
-except ImportError:
-    pytesseract = None
-    convert_from_bytes = None
-    Image = None
-
-from openai import OpenAI
-import google.generativeai as genai
-from anthropic import Anthropic
-import httpx
+# Heavy SDKs (LLM providers, pypdf, reportlab, OCR) are imported on first use; see _openai_sdk() & co.
+HAS_OCR = all(importlib.util.find_spec(m) is not None for m in ("pytesseract", "pdf2image"))
 
 
 # ============================================================
@@ -150,6 +147,7 @@ I18N: Dict[str, Dict[str, str]] = {
         "error": "Error",
         "clear_history": "Clear history",
         "export_history": "Export history (CSV)",
+        "export_history_arrow": "Export history (Arrow)",
         "note_upload": "Upload note file (.pdf/.txt/.md)",
         "note_paste": "Paste your notes (text/markdown)",
         "note_transform": "Transform to organized Markdown + coral keywords",
@@ -167,6 +165,7 @@ I18N: Dict[str, Dict[str, str]] = {
         "step": "Step",
         "run_step": "Run step",
         "run_next": "Run next",
+        "run_remaining": "Run remaining",
         "workflow_input": "Workflow Input",
         "workflow_output": "Workflow Output",
         "add_step": "Add step",
@@ -224,6 +223,7 @@ I18N: Dict[str, Dict[str, str]] = {
         "error": "錯誤",
         "clear_history": "清除紀錄",
         "export_history": "匯出紀錄（CSV）",
+        "export_history_arrow": "匯出紀錄（Arrow）",
         "note_upload": "上傳筆記檔（.pdf/.txt/.md）",
         "note_paste": "貼上筆記（文字/Markdown）",
         "note_transform": "整理成結構化 Markdown + 珊瑚色關鍵字",
@@ -241,6 +241,7 @@ I18N: Dict[str, Dict[str, str]] = {
         "step": "步驟",
         "run_step": "執行本步驟",
         "run_next": "執行下一步",
+        "run_remaining": "執行剩餘步驟",
         "workflow_input": "工作流輸入",
         "workflow_output": "工作流輸出",
         "add_step": "新增步驟",
@@ -311,17 +312,13 @@ STYLE_TOKENS: Dict[str, Dict[str, str]] = {
 }
 
 
-def apply_style_engine(theme_mode: str, painter_style: str):
-    tokens = STYLE_TOKENS.get(painter_style, STYLE_TOKENS["Van Gogh"])
-    is_dark = theme_mode.lower() == "dark"
-    text_color = "#e5e7eb" if is_dark else "#0f172a"
-    subtext = "#cbd5e1" if is_dark else "#334155"
-    shadow = "0 18px 50px rgba(0,0,0,0.38)" if is_dark else "0 18px 50px rgba(2,6,23,0.18)"
-    glass = "rgba(17,24,39,0.38)" if is_dark else "rgba(255,255,255,0.55)"
+# Pre-joined, read-only ":root" custom-property declarations per style ("--bg1:#..;--bg2:#..;...").
+# STYLE_TOKENS stays the editable source of truth; rendering only ever reads this frozen view.
+STYLE_TOKENS_CSS: MappingProxyType = MappingProxyType({
+    name: "".join(f"{k}:{v};" for k, v in toks.items()) for name, toks in STYLE_TOKENS.items()
+})
 
-    splatter = ""
-    if painter_style == "Pollock":
-        splatter = """
+POLLOCK_SPLATTER_CSS = """
         body:before{
             content:"";
             position:fixed; inset:0;
@@ -337,10 +334,26 @@ def apply_style_engine(theme_mode: str, painter_style: str):
         }
         """
 
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _build_style_css(theme_mode: str, painter_style: str) -> str:
+    """
+    Builds the full <style> block; inputs come from a small closed set, so it is memoized.
+    cache_resource rather than lru_cache: module globals are rebuilt on every rerun, the Streamlit cache is not.
+    """
+    root_tokens = STYLE_TOKENS_CSS.get(painter_style, STYLE_TOKENS_CSS["Van Gogh"])
+    is_dark = theme_mode.lower() == "dark"
+    text_color = "#e5e7eb" if is_dark else "#0f172a"
+    subtext = "#cbd5e1" if is_dark else "#334155"
+    shadow = "0 18px 50px rgba(0,0,0,0.38)" if is_dark else "0 18px 50px rgba(2,6,23,0.18)"
+    glass = "rgba(17,24,39,0.38)" if is_dark else "rgba(255,255,255,0.55)"
+
+    splatter = POLLOCK_SPLATTER_CSS if painter_style == "Pollock" else ""
+
     css = f"""
     <style>
     :root {{
-        {"".join([f"{k}:{v};" for k,v in tokens.items()])}
+        {root_tokens}
         --text: {text_color};
         --subtext: {subtext};
         --glass: {glass};
@@ -478,34 +491,51 @@ def apply_style_engine(theme_mode: str, painter_style: str):
     }}
     </style>
     """
-    st.markdown(css, unsafe_allow_html=True)
+    return css
+
+
+def apply_style_engine(theme_mode: str, painter_style: str):
+    st.markdown(_build_style_css(theme_mode, painter_style), unsafe_allow_html=True)
 
 
 # ============================================================
 # 4) Data Loading Logic (Datasets & Guidance)
 # ============================================================
-def load_default_datasets_from_file() -> Tuple[Dict[str, Any], Dict[str, Any]]:
-    """Loads defaultdataset.json containing tw_cases and k510_checklists."""
+DEFAULT_DATASET_PATH = "defaultdataset.json"
+DEFAULT_GUIDE_PATH = "defaultguide.md"
+
+
+def _file_mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+@st.cache_data(show_spinner=False)
+def load_default_datasets_from_file(path: str = DEFAULT_DATASET_PATH, mtime: float = 0.0) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Loads defaultdataset.json containing tw_cases and k510_checklists (cached per path + mtime)."""
     tw_cases = {}
     k510_checklists = {}
     try:
-        with open("defaultdataset.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(path, "rb") as f:
+            raw = f.read()
+            data = orjson.loads(raw) if orjson else json.loads(raw)
             tw_cases = data.get("tw_cases", {})
             k510_checklists = data.get("k510_checklists", {})
     except FileNotFoundError:
-        st.error("Default dataset file 'defaultdataset.json' not found.")
+        st.error(f"Default dataset file '{path}' not found.")
     except Exception as e:
-        st.error(f"Error loading defaultdataset.json: {e}")
+        st.error(f"Error loading {path}: {e}")
     return tw_cases, k510_checklists
 
-def load_default_guidance_from_file() -> Tuple[Dict[str, Dict[str, str]], Dict[str, Dict[str, str]]]:
-    """Loads defaultguide.md and parses sections for TW and 510k guidances."""
+@st.cache_data(show_spinner=False)
+def load_default_guidance_from_file(path: str = DEFAULT_GUIDE_PATH, mtime: float = 0.0) -> Tuple[Dict[str, Dict[str, str]], Dict[str, Dict[str, str]]]:
+    """Loads defaultguide.md and parses sections for TW and 510k guidances (cached per path + mtime)."""
     tw_guides = {}
     k510_guides = {}
     
     try:
-        with open("defaultguide.md", "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             content = f.read()
         
         # Regex to find sections: <!-- BEGIN_SECTION: id | TITLE: title --> ... <!-- END_SECTION -->
@@ -527,15 +557,15 @@ def load_default_guidance_from_file() -> Tuple[Dict[str, Dict[str, str]], Dict[s
                 k510_guides[key] = entry
                 
     except FileNotFoundError:
-        st.error("Default guidance file 'defaultguide.md' not found.")
+        st.error(f"Default guidance file '{path}' not found.")
     except Exception as e:
-        st.error(f"Error loading defaultguide.md: {e}")
+        st.error(f"Error loading {path}: {e}")
         
     return tw_guides, k510_guides
 
 def refresh_defaults():
-    tw_c, k510_c = load_default_datasets_from_file()
-    tw_g, k510_g = load_default_guidance_from_file()
+    tw_c, k510_c = load_default_datasets_from_file(DEFAULT_DATASET_PATH, _file_mtime(DEFAULT_DATASET_PATH))
+    tw_g, k510_g = load_default_guidance_from_file(DEFAULT_GUIDE_PATH, _file_mtime(DEFAULT_GUIDE_PATH))
     st.session_state["DEFAULT_TW_CASESETS"] = tw_c
     st.session_state["DEFAULT_510K_CHECKLIST_SETS"] = k510_c
     st.session_state["DEFAULT_TW_GUIDANCES"] = tw_g
@@ -572,6 +602,7 @@ if "workflow" not in st.session_state:
         "input": "",
         "outputs": [],
         "statuses": [],
+        "batches": {},  # step index -> pending Batch API request (see submit_workflow_batch)
     }
 
 # New state for TW datasets/guidance/templates/mapping
@@ -664,6 +695,23 @@ if "tw_field_mapping" not in st.session_state:
         "AHWP": "cert_ahwp",
     }
 
+
+def tw_field_mapping_frozen() -> MappingProxyType:
+    """
+    Read-only, interned view of st.session_state["tw_field_mapping"] for the hot standardization loops.
+    Rebuilt only when the editable mapping dict is replaced (editor save / upload merge).
+    """
+    source = st.session_state["tw_field_mapping"]
+    cached = st.session_state.get("tw_field_mapping_frozen")
+    if cached is None or cached[0] is not source:
+        frozen = MappingProxyType({
+            (sys.intern(k) if isinstance(k, str) else k): (sys.intern(v) if isinstance(v, str) else v)
+            for k, v in source.items()
+        })
+        cached = (source, frozen)
+        st.session_state["tw_field_mapping_frozen"] = cached
+    return cached[1]
+
 # New state for 510k checklist/guidance manager
 if "k510_checklist_dataset" not in st.session_state:
     st.session_state["k510_checklist_dataset"] = []  # list of dicts
@@ -712,6 +760,63 @@ def api_status(provider: str) -> Tuple[str, str]:
 # ============================================================
 # 6) LLM call router
 # ============================================================
+GROK_BASE_URL = "https://api.x.ai/v1"
+
+
+@functools.lru_cache(maxsize=None)
+def _openai_sdk():
+    import openai
+    return openai
+
+
+@functools.lru_cache(maxsize=None)
+def _anthropic_sdk():
+    import anthropic
+    return anthropic
+
+
+@functools.lru_cache(maxsize=None)
+def _genai_sdk():
+    import google.generativeai as genai
+    return genai
+
+
+@functools.lru_cache(maxsize=None)
+def _httpx_sdk():
+    import httpx
+    return httpx
+
+
+# SDK clients are memoized per (provider, key) so their connection pools survive across calls and reruns.
+# Cache keys use a digest of the API key; the leading "_" keeps Streamlit from hashing the raw key.
+def _key_id(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+@st.cache_resource(show_spinner=False)
+def _openai_client(key_id: str, _key: str):
+    return _openai_sdk().OpenAI(api_key=_key)
+
+
+@st.cache_resource(show_spinner=False)
+def _anthropic_client(key_id: str, _key: str):
+    return _anthropic_sdk().Anthropic(api_key=_key)
+
+
+@st.cache_resource(show_spinner=False)
+def _gemini_model(key_id: str, model: str, _key: str):
+    genai = _genai_sdk()
+    genai.configure(api_key=_key)
+    return genai.GenerativeModel(model)
+
+
+@st.cache_resource(show_spinner=False)
+def _grok_client():
+    """Shared keep-alive client for the xAI API (the key travels per request in the Authorization header)."""
+    httpx = _httpx_sdk()
+    return httpx.Client(base_url=GROK_BASE_URL, timeout=90, limits=httpx.Limits(max_keepalive_connections=4))
+
+
 def call_llm(
     model: str,
     system_prompt: str,
@@ -727,8 +832,7 @@ def call_llm(
         raise RuntimeError(f"Missing API key for provider: {provider}")
 
     if provider == "openai":
-        client = OpenAI(api_key=key)
-        resp = client.chat.completions.create(
+        resp = _openai_client(_key_id(key), key).chat.completions.create(
             model=model,
             messages=[
                 {"role": "system", "content": system_prompt or ""},
@@ -740,17 +844,15 @@ def call_llm(
         return resp.choices[0].message.content
 
     if provider == "gemini":
-        genai.configure(api_key=key)
-        llm = genai.GenerativeModel(model)
-        resp = llm.generate_content(
+        _genai_sdk().configure(api_key=key)  # genai keeps the key in global config; re-point it before each call
+        resp = _gemini_model(_key_id(key), model, key).generate_content(
             (system_prompt or "").strip() + "\n\n" + (user_prompt or "").strip(),
             generation_config={"max_output_tokens": max_tokens, "temperature": temperature},
         )
         return resp.text
 
     if provider == "anthropic":
-        client = Anthropic(api_key=key)
-        resp = client.messages.create(
+        resp = _anthropic_client(_key_id(key), key).messages.create(
             model=model,
             system=system_prompt or "",
             max_tokens=max_tokens,
@@ -760,91 +862,359 @@ def call_llm(
         return resp.content[0].text
 
     if provider == "grok":
-        with httpx.Client(base_url="https://api.x.ai/v1", timeout=90) as client:
-            resp = client.post(
-                "/chat/completions",
-                headers={"Authorization": f"Bearer {key}"},
-                json={
-                    "model": model,
-                    "messages": [
-                        {"role": "system", "content": system_prompt or ""},
-                        {"role": "user", "content": user_prompt or ""},
-                    ],
-                    "max_tokens": max_tokens,
-                    "temperature": temperature,
-                },
-            )
-            resp.raise_for_status()
-            data = resp.json()
+        resp = _grok_client().post(
+            "/chat/completions",
+            headers={"Authorization": f"Bearer {key}"},
+            json={
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": system_prompt or ""},
+                    {"role": "user", "content": user_prompt or ""},
+                ],
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+            },
+        )
+        resp.raise_for_status()
+        data = resp.json()
         return data["choices"][0]["message"]["content"]
 
     raise RuntimeError(f"Unsupported provider for model {model}")
 
 
+def call_llm_stream(
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    api_keys: Optional[dict] = None,
+) -> Iterator[str]:
+    """Same request as call_llm, yielding the reply's text deltas as the provider produces them."""
+    provider = get_provider(model)
+    api_keys = api_keys or {}
+    key = get_api_key(provider, api_keys)
+    if not key:
+        raise RuntimeError(f"Missing API key for provider: {provider}")
+
+    if provider == "openai":
+        stream = _openai_client(_key_id(key), key).chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt or ""},
+                {"role": "user", "content": user_prompt or ""},
+            ],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        return
+
+    if provider == "gemini":
+        _genai_sdk().configure(api_key=key)
+        resp = _gemini_model(_key_id(key), model, key).generate_content(
+            (system_prompt or "").strip() + "\n\n" + (user_prompt or "").strip(),
+            generation_config={"max_output_tokens": max_tokens, "temperature": temperature},
+            stream=True,
+        )
+        for chunk in resp:
+            if chunk.parts:
+                yield chunk.text
+        return
+
+    if provider == "anthropic":
+        with _anthropic_client(_key_id(key), key).messages.stream(
+            model=model,
+            system=system_prompt or "",
+            max_tokens=max_tokens,
+            temperature=temperature,
+            messages=[{"role": "user", "content": user_prompt or ""}],
+        ) as stream:
+            yield from stream.text_stream
+        return
+
+    if provider == "grok":
+        with _grok_client().stream(
+            "POST",
+            "/chat/completions",
+            headers={"Authorization": f"Bearer {key}"},
+            json={
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": system_prompt or ""},
+                    {"role": "user", "content": user_prompt or ""},
+                ],
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stream": True,
+            },
+        ) as resp:
+            resp.raise_for_status()
+            # OpenAI-compatible server-sent events: "data: {...}" lines, terminated by "data: [DONE]".
+            for line in resp.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+        return
+
+    raise RuntimeError(f"Unsupported provider for model {model}")
+
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=500)
+def _cached_call_llm(model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float, key_id: str, _api_keys: dict) -> str:
+    return call_llm(model, system_prompt, user_prompt, max_tokens, temperature, _api_keys)
+
+
+def call_llm_cached(
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    api_keys: Optional[dict] = None,
+) -> str:
+    """
+    call_llm memoized for an hour on the full request, so re-running an unchanged step skips the provider.
+    The cache is keyed on a digest of the resolved API key rather than the key itself; errors are not cached.
+    """
+    api_keys = api_keys or {}
+    key = get_api_key(get_provider(model), api_keys)
+    return _cached_call_llm(model, system_prompt or "", user_prompt or "", int(max_tokens), float(temperature), _key_id(key) if key else "", api_keys)
+
+
+def write_llm_stream(**req: Any) -> str:
+    """Stream a call_llm_stream reply into the current Streamlit container and return the full text."""
+    chunks: List[str] = []
+
+    def deltas() -> Iterator[str]:
+        for d in call_llm_stream(**req):
+            chunks.append(d)
+            yield d
+
+    st.write_stream(deltas())
+    return "".join(chunks)
+
+
+# Providers whose Batch APIs bill at about half the synchronous token price (results within 24h).
+BATCH_PROVIDERS = frozenset({"openai", "anthropic"})
+
+
+def submit_llm_batch(
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    api_keys: Optional[dict] = None,
+) -> Dict[str, str]:
+    """
+    Queue a single request on the provider's Batch API instead of calling it synchronously.
+    Returns a handle for poll_llm_batch.
+    """
+    provider = get_provider(model)
+    if provider not in BATCH_PROVIDERS:
+        raise RuntimeError(f"Batch mode is not supported for provider: {provider}")
+    key = get_api_key(provider, api_keys or {})
+    if not key:
+        raise RuntimeError(f"Missing API key for provider: {provider}")
+
+    if provider == "openai":
+        client = _openai_client(_key_id(key), key)
+        line = {
+            "custom_id": "req-0",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": system_prompt or ""},
+                    {"role": "user", "content": user_prompt or ""},
+                ],
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+            },
+        }
+        f = client.files.create(file=("batch.jsonl", _json_text(line).encode("utf-8")), purpose="batch")
+        batch = client.batches.create(input_file_id=f.id, endpoint="/v1/chat/completions", completion_window="24h")
+    else:
+        batch = _anthropic_client(_key_id(key), key).messages.batches.create(
+            requests=[
+                {
+                    "custom_id": "req-0",
+                    "params": {
+                        "model": model,
+                        "system": system_prompt or "",
+                        "max_tokens": max_tokens,
+                        "temperature": temperature,
+                        "messages": [{"role": "user", "content": user_prompt or ""}],
+                    },
+                }
+            ]
+        )
+    return {"provider": provider, "batch_id": batch.id}
+
+
+def poll_llm_batch(handle: Dict[str, str], api_keys: Optional[dict] = None) -> Optional[str]:
+    """Return the batched request's text once it has finished, None while it is still running; raises if it failed."""
+    provider, batch_id = handle["provider"], handle["batch_id"]
+    key = get_api_key(provider, api_keys or {})
+    if not key:
+        raise RuntimeError(f"Missing API key for provider: {provider}")
+
+    if provider == "openai":
+        client = _openai_client(_key_id(key), key)
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"Batch {batch_id} {batch.status}")
+        if batch.status != "completed":
+            return None
+        if not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch_id} completed without output (see error file {batch.error_file_id})")
+        result = json.loads(client.files.content(batch.output_file_id).text.splitlines()[0])
+        if result.get("error"):
+            raise RuntimeError(f"Batch request failed: {result['error']}")
+        return result["response"]["body"]["choices"][0]["message"]["content"]
+
+    client = _anthropic_client(_key_id(key), key)
+    if client.messages.batches.retrieve(batch_id).processing_status != "ended":
+        return None
+    for entry in client.messages.batches.results(batch_id):
+        if entry.result.type == "succeeded":
+            return entry.result.message.content[0].text
+        raise RuntimeError(f"Batch request {entry.result.type}: {getattr(entry.result, 'error', '')}")
+    raise RuntimeError(f"Batch {batch_id} ended without results")
+
+
 # ============================================================
 # 7) Generic helpers
 # ============================================================
-def est_tokens(text: str) -> int:
-    # Simple estimate: 4 chars per token
-    return max(1, int(len(text or "") / 4))
+@st.cache_resource(show_spinner=False)
+def _token_encoder(model: str):
+    """
+    tiktoken encoder for `model` (o200k_base for non-OpenAI models), or None if tiktoken is not installed or
+    its BPE file can't be fetched (first use downloads it; offline deploys fall back to the char estimate).
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def est_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    text = text or ""
+    enc = _token_encoder(model)
+    if enc is None:
+        # Simple estimate: 4 chars per token
+        return (len(text) >> 2) or 1
+    return len(enc.encode(text, disallowed_special=())) or 1
 
 
 def log_event(tab: str, agent: str, model: str, tokens_est: int, meta: Optional[dict] = None):
     st.session_state["history"].append(
-        {"tab": tab, "agent": agent, "model": model, "tokens_est": int(tokens_est), "ts": datetime.utcnow().isoformat(), "meta": meta or {}}
+        {"tab": tab, "agent": agent, "model": model, "tokens_est": int(tokens_est), "ts_ns": time.time_ns(), "meta": meta or {}}
     )
 
 
-def extract_pdf_pages_to_text(file, start_page: int, end_page: int, use_ocr: bool = False) -> str:
-    pdf_text = ""
+def history_to_df(hist: List[dict]) -> pd.DataFrame:
+    """
+    Build the history frame with a datetime `ts` column. Events store raw `ts_ns` ints (cheap to log);
+    they are converted here in one vectorized pass. Older entries with an ISO `ts` string are kept.
+    """
+    if not hist:
+        return pd.DataFrame(columns=["tab", "agent", "model", "tokens_est", "ts"])
+    df = pd.DataFrame(hist)
+    ts = pd.to_datetime(df["ts"], format="ISO8601", errors="coerce") if "ts" in df.columns else None
+    if "ts_ns" in df.columns:
+        ts_ns = pd.to_datetime(df.pop("ts_ns"), unit="ns")
+        ts = ts_ns if ts is None else ts_ns.fillna(ts)
+    df["ts"] = ts
+    return df
+
+
+def _pypdf_pages_to_text(file, start_page: int, end_page: int) -> str:
     try:
+        from pypdf import PdfReader
+
         reader = PdfReader(file)
-        n = len(reader.pages)
+        pages = reader.pages
+        n = len(pages)
         start = max(0, start_page - 1)
         end = min(n, end_page)
-        raw_texts = []
-        for i in range(start, end):
+        raw_texts = [""] * max(0, end - start)
+        for k, i in enumerate(range(start, end)):
             try:
-                page_text = reader.pages[i].extract_text() or ""
-                raw_texts.append(page_text)
+                raw_texts[k] = pages[i].extract_text() or ""
             except Exception:
-                raw_texts.append("")
-        pdf_text = "\n\n".join(raw_texts).strip()
+                pass
+        return "\n\n".join(raw_texts).strip()
     except Exception as e:
         print(f"pypdf extraction error: {e}")
+        return ""
+
 
+def extract_pdf_pages_to_text(file, start_page: int, end_page: int, use_ocr: bool = False) -> str:
     if use_ocr:
-        if pytesseract is None or convert_from_bytes is None:
-            return pdf_text + "\n\n[System: OCR requested but libraries (pytesseract/pdf2image) are missing.]"
+        if not HAS_OCR:
+            return _pypdf_pages_to_text(file, start_page, end_page) + "\n\n[System: OCR requested but libraries (pytesseract/pdf2image) are missing.]"
+        # OCR path: skip the pypdf parse unless OCR itself fails.
         ocr_text = []
         file.seek(0)
         try:
+            import pytesseract
+            from pdf2image import convert_from_bytes
+
             images = convert_from_bytes(file.read(), first_page=start_page, last_page=end_page)
             for img in images:
                 text = pytesseract.image_to_string(img, lang="eng+chi_tra")
                 ocr_text.append(text)
             return "\n\n".join(ocr_text).strip()
         except Exception as e:
-            return pdf_text + f"\n\n[System: OCR failed: {e}]"
+            file.seek(0)
+            return _pypdf_pages_to_text(file, start_page, end_page) + f"\n\n[System: OCR failed: {e}]"
 
-    return pdf_text
+    return _pypdf_pages_to_text(file, start_page, end_page)
 
 
 def create_pdf_from_text(text: str) -> bytes:
-    if canvas is None or letter is None:
+    try:
+        from reportlab.pdfgen import canvas
+        from reportlab.lib.pagesizes import letter
+    except ImportError:
         raise RuntimeError("Missing 'reportlab'. Add 'reportlab' to requirements.txt to export PDF.")
     buf = BytesIO()
     c = canvas.Canvas(buf, pagesize=letter)
     width, height = letter
     margin = 72
     line_height = 14
-    y = height - margin
+
+    def _new_text_object():
+        obj = c.beginText(margin, height - margin)
+        obj.setFont("Helvetica", 12, leading=line_height)
+        return obj
+
+    text_obj = _new_text_object()
     for line in (text or "").splitlines():
-        if y < margin:
+        if text_obj.getY() < margin:
+            c.drawText(text_obj)
             c.showPage()
-            y = height - margin
-        c.drawString(margin, y, line[:2000])
-        y -= line_height
+            text_obj = _new_text_object()
+        text_obj.textLine(line[:2000])
+    c.drawText(text_obj)
     c.save()
     buf.seek(0)
     return buf.getvalue()
@@ -853,29 +1223,38 @@ def create_pdf_from_text(text: str) -> bytes:
 def show_pdf(pdf_bytes: bytes, height: int = 600):
     if not pdf_bytes:
         return
-    b64 = base64.b64encode(pdf_bytes).decode("utf-8")
-    st.markdown(f"""<iframe src="data:application/pdf;base64,{b64}" width="100%" height="{height}"></iframe>""", unsafe_allow_html=True)
+    b64 = base64.b64encode(memoryview(pdf_bytes)).decode("ascii")
+    st.markdown(
+        "".join(('<iframe src="data:application/pdf;base64,', b64, f'" width="100%" height="{height}"></iframe>')),
+        unsafe_allow_html=True,
+    )
 
 
-def status_row(label: str, status: str):
-    color_class = {
-        "pending": "dot-amber",
-        "running": "dot-amber",
-        "done": "dot-green",
-        "error": "dot-red",
-        "idle": "dot-amber",
-        "thinking": "dot-amber",
-        "active": "dot-green",
-    }.get(status, "dot-amber")
+_STATUS_COLORS = {
+    "pending": "dot-amber",
+    "running": "dot-amber",
+    "done": "dot-green",
+    "error": "dot-red",
+    "idle": "dot-amber",
+    "thinking": "dot-amber",
+    "queued": "dot-amber",
+    "active": "dot-green",
+}
 
-    st.markdown(
-        f"""
+_STATUS_ROW_TPL = string.Template(
+    """
         <div style="display:flex; align-items:center; gap:10px; margin:2px 0;">
-          <span class="dot {color_class}"></span>
-          <div style="font-weight:800;">{label}</div>
-          <span class="wow-badge">{status}</span>
+          <span class="dot $cls"></span>
+          <div style="font-weight:800;">$label</div>
+          <span class="wow-badge">$status</span>
         </div>
-        """,
+        """
+)
+
+
+def status_row(label: str, status: str):
+    st.markdown(
+        _STATUS_ROW_TPL.substitute(cls=_STATUS_COLORS.get(status, "dot-amber"), label=label, status=status),
         unsafe_allow_html=True,
     )
 
@@ -883,47 +1262,59 @@ def status_row(label: str, status: str):
 # ============================================================
 # 8) Guidance struct conversion + merge/diff utilities
 # ============================================================
+_RE_NL3PLUS = re.compile(r"\n{3,}")
+
+
 def normalize_md(md: str) -> str:
-    return re.sub(r"\n{3,}", "\n\n", (md or "").strip())
+    return _RE_NL3PLUS.sub("\n\n", (md or "").strip())
 
 
-def _find_section(md: str, patterns: List[str]) -> str:
+# Heading patterns per guidance section, compiled once.
+_SECTION_PATTERNS: Dict[str, Tuple["re.Pattern[str]", ...]] = {
+    "purpose": tuple(re.compile(p) for p in (r"^##\s*0\.", r"審查目的")),
+    "req": tuple(re.compile(p) for p in (r"必要文件清單", r"^##\s*1\.")),
+    "checks": tuple(re.compile(p) for p in (r"關鍵欄位檢核", r"一致性", r"^##\s*2\.", r"^##\s*3\.")),
+    "defects": tuple(re.compile(p) for p in (r"常見缺失", r"^##\s*4\.")),
+    "outfmt": tuple(re.compile(p) for p in (r"建議輸出格式", r"^##\s*5\.")),
+}
+
+
+def _split_guidance_sections(md: str) -> Dict[str, str]:
     """
-    Extract section content for the first matched heading pattern.
-    patterns: list of regex patterns to match headings like '## 0. 審查目的'
+    Single pass over the markdown: for each key in _SECTION_PATTERNS, take the first line matching
+    one of its patterns and capture the lines after it up to the next '## ' heading.
     """
-    text = normalize_md(md)
-    lines = text.splitlines()
-    idx = None
+    lines = normalize_md(md).splitlines()
+    starts: Dict[str, int] = {}
+    headings: List[int] = []
+    pending = list(_SECTION_PATTERNS.items())
     for i, line in enumerate(lines):
-        for pat in patterns:
-            if re.search(pat, line.strip()):
-                idx = i
-                break
-        if idx is not None:
-            break
-    if idx is None:
-        return ""
+        s = line.strip()
+        if s.startswith("## "):
+            headings.append(i)
+        if pending:
+            for kind, compiled in pending:
+                if any(c.search(s) for c in compiled):
+                    starts[kind] = i
+            pending = [(k, c) for k, c in pending if k not in starts]
+
+    sections: Dict[str, str] = {}
+    for kind in _SECTION_PATTERNS:
+        idx = starts.get(kind)
+        if idx is None:
+            sections[kind] = ""
+            continue
+        end = headings[bisect.bisect_right(headings, idx)] if headings and headings[-1] > idx else len(lines)
+        sections[kind] = normalize_md("\n".join(lines[idx + 1:end])).strip()
+    return sections
+
 
-    # capture until next heading starting with ##
-    out = []
-    for j in range(idx + 1, len(lines)):
-        if lines[j].strip().startswith("## "):
-            break
-        out.append(lines[j])
-    return normalize_md("\n".join(out)).strip()
+# Numbered ("1.") or dash ("- ") list item, leading/trailing blanks on the line ignored.
+_RE_LIST_ITEM = re.compile(r"^[^\S\n]*(?:\d+\.|- )(.*)$", re.MULTILINE)
 
 
 def _extract_list_items(section_text: str) -> List[str]:
-    items = []
-    for line in (section_text or "").splitlines():
-        s = line.strip()
-        # numbered list "1." or "- "
-        if re.match(r"^\d+\.", s):
-            items.append(re.sub(r"^\d+\.\s*", "", s).strip())
-        elif s.startswith("- "):
-            items.append(s[2:].strip())
-    return [x for x in items if x]
+    return [x for x in (m.group(1).strip() for m in _RE_LIST_ITEM.finditer(section_text or "")) if x]
 
 
 def guidance_markdown_to_struct(md: str) -> Dict[str, Any]:
@@ -939,11 +1330,12 @@ def guidance_markdown_to_struct(md: str) -> Dict[str, Any]:
     """
     md = normalize_md(md)
 
-    purpose = _find_section(md, [r"^##\s*0\.", r"審查目的"])
-    req = _find_section(md, [r"必要文件清單", r"^##\s*1\."])
-    checks = _find_section(md, [r"關鍵欄位檢核", r"一致性", r"^##\s*2\.", r"^##\s*3\."])
-    defects = _find_section(md, [r"常見缺失", r"^##\s*4\."])
-    outfmt = _find_section(md, [r"建議輸出格式", r"^##\s*5\."])
+    sections = _split_guidance_sections(md)
+    purpose = sections["purpose"]
+    req = sections["req"]
+    checks = sections["checks"]
+    defects = sections["defects"]
+    outfmt = sections["outfmt"]
 
     required_documents = _extract_list_items(req)
     # checks may include bullet list
@@ -963,35 +1355,78 @@ def guidance_markdown_to_struct(md: str) -> Dict[str, Any]:
     }
 
 
+def _rows_to_csv_bytes(header: List[str], rows: List[List[Any]]) -> bytes:
+    # Plain csv.writer: these exports are a handful of rows, not worth a DataFrame round-trip.
+    buf = StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(header)
+    w.writerows(rows)
+    return buf.getvalue().encode("utf-8")
+
+
 def guidance_struct_to_one_row_csv(struct: Dict[str, Any]) -> bytes:
-    row = {
-        "purpose": struct.get("purpose", ""),
-        "required_documents": " | ".join(struct.get("required_documents", []) or []),
-        "consistency_checks": " | ".join(struct.get("consistency_checks", []) or []),
-        "common_defects": " | ".join(struct.get("common_defects", []) or []),
-        "output_format": struct.get("output_format", ""),
-    }
-    return pd.DataFrame([row]).to_csv(index=False).encode("utf-8")
+    return _rows_to_csv_bytes(
+        ["purpose", "required_documents", "consistency_checks", "common_defects", "output_format"],
+        [[
+            struct.get("purpose", ""),
+            " | ".join(struct.get("required_documents", []) or []),
+            " | ".join(struct.get("consistency_checks", []) or []),
+            " | ".join(struct.get("common_defects", []) or []),
+            struct.get("output_format", ""),
+        ]],
+    )
 
 
 def guidance_required_docs_csv(struct: Dict[str, Any]) -> bytes:
     docs = struct.get("required_documents", []) or []
-    df = pd.DataFrame([{"doc_item": d, "required": True} for d in docs])
-    return df.to_csv(index=False).encode("utf-8")
+    return _rows_to_csv_bytes(["doc_item", "required"], [[d, True] for d in docs])
 
 
 def merge_guidance_markdowns(mds: List[str], extra_rules_md: str = "") -> str:
-    parts = [normalize_md(x) for x in (mds or []) if normalize_md(x)]
+    parts = [p for p in (normalize_md(x) for x in (mds or [])) if p]
     if extra_rules_md and extra_rules_md.strip():
         parts.append("## 自訂追加規則\n" + normalize_md(extra_rules_md))
-    return normalize_md("\n\n---\n\n".join(parts))
+    # Parts are already normalized and stripped, so joining cannot create new blank-line runs.
+    return "\n\n---\n\n".join(parts)
+
+
+_HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@", re.MULTILINE)
+DIFF_CONTEXT_LINES = 3
 
 
 def diff_markdown(a: str, b: str) -> str:
     a_lines = (a or "").splitlines(keepends=True)
     b_lines = (b or "").splitlines(keepends=True)
-    diff = difflib.unified_diff(a_lines, b_lines, fromfile="A.md", tofile="B.md")
-    return "".join(diff).strip()
+    if a_lines == b_lines:
+        return ""
+
+    # Trim the shared head/tail (keeping the diff context) so the matcher only sees the changed region.
+    n = min(len(a_lines), len(b_lines))
+    head = 0
+    while head < n and a_lines[head] == b_lines[head]:
+        head += 1
+    tail = 0
+    while tail < n - head and a_lines[-1 - tail] == b_lines[-1 - tail]:
+        tail += 1
+    lo = max(0, head - DIFF_CONTEXT_LINES)
+    tail = max(0, tail - DIFF_CONTEXT_LINES)
+
+    diff = "".join(
+        difflib.unified_diff(
+            a_lines[lo:len(a_lines) - tail],
+            b_lines[lo:len(b_lines) - tail],
+            fromfile="A.md",
+            tofile="B.md",
+            n=DIFF_CONTEXT_LINES,
+        )
+    ).strip()
+    if not lo:
+        return diff
+    # Shift hunk line numbers back to whole-document positions.
+    return _HUNK_HEADER_RE.sub(
+        lambda m: f"@@ -{int(m.group(1)) + lo}{m.group(2) or ''} +{int(m.group(3)) + lo}{m.group(4) or ''} @@",
+        diff,
+    )
 
 
 # ============================================================
@@ -1014,28 +1449,41 @@ TW_APP_FIELDS = [
     "preclinical_info", "preclinical_replace",
     "clinical_just", "clinical_info",
 ]
+# Set view for membership tests; TW_APP_FIELDS keeps the canonical order.
+_TW_APP_FIELDS_SET = frozenset(TW_APP_FIELDS)
+# (field, session-state widget key) for every TW_APP_FIELDS entry; the key is "tw_<field>" unless listed here.
+_TW_SESSION_KEY_OVERRIDES = {
+    "name_zh": "tw_dev_name_zh",
+    "name_en": "tw_dev_name_en",
+    "auth_applicable": "tw_auth_app",
+    "cfs_applicable": "tw_cfs_app",
+    "qms_applicable": "tw_qms_app",
+    "clinical_just": "tw_clinical_app",
+}
+TW_APP_SESSION_KEYS = tuple((f, _TW_SESSION_KEY_OVERRIDES.get(f, "tw_" + f)) for f in TW_APP_FIELDS)
+
+_TRUTHY = frozenset({"true", "1", "yes", "y", "是", "有", "勾選", "checked"})
+
 
 def _to_bool(v: Any) -> bool:
-    if isinstance(v, bool):
+    if v is True or v is False:
         return v
     if v is None:
         return False
-    s = str(v).strip().lower()
-    if s in {"true", "1", "yes", "y", "是", "有", "勾選", "checked"}:
-        return True
-    return False
+    # Numbers (e.g. CSV 0/1 columns, which pandas reads as float when blanks are present): only 1 is truthy.
+    if type(v) is int or type(v) is float:
+        return v == 1
+    return str(v).strip().lower() in _TRUTHY
 
 
-def _normalize_apply_date(v: Any) -> str:
-    if v is None:
-        return ""
-    if isinstance(v, (datetime, date)):
-        return v.strftime("%Y-%m-%d")
-    s = str(v).strip()
-    if not s:
-        return ""
+_DATE_SEP_RE = re.compile(r"^\s*(\d{4})[\/\.-](\d{1,2})[\/\.-](\d{1,2})\s*$")
+_DATE_ISO_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_apply_date_str(s: str) -> str:
     # Accept YYYY-MM-DD or YYYY/MM/DD or YYYY.MM.DD
-    m = re.match(r"^\s*(\d{4})[\/\.-](\d{1,2})[\/\.-](\d{1,2})\s*$", s)
+    m = _DATE_SEP_RE.match(s)
     if m:
         y, mo, d = m.group(1), int(m.group(2)), int(m.group(3))
         try:
@@ -1043,7 +1491,7 @@ def _normalize_apply_date(v: Any) -> str:
         except Exception:
             return ""
     # If already YYYY-MM-DD but with extra text, best effort:
-    m2 = re.search(r"(\d{4})-(\d{2})-(\d{2})", s)
+    m2 = _DATE_ISO_RE.search(s)
     if m2:
         try:
             return date(int(m2.group(1)), int(m2.group(2)), int(m2.group(3))).strftime("%Y-%m-%d")
@@ -1052,61 +1500,192 @@ def _normalize_apply_date(v: Any) -> str:
     return ""
 
 
-def standardize_tw_record_rule_mapping(raw: Dict[str, Any], mapping: Dict[str, str]) -> Dict[str, Any]:
+def _normalize_apply_date(v: Any) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, (datetime, date)):
+        return v.strftime("%Y-%m-%d")
+    s = str(v).strip()
+    if not s:
+        return ""
+    # Uploads tend to repeat the same few dates; the string path is memoized.
+    return _normalize_apply_date_str(s)
+
+
+# Per-field normalization rule, in TW_APP_FIELDS order.
+_ACT_BOOL, _ACT_DATE, _ACT_STR = 0, 1, 2
+_FIELD_ACTION: Dict[str, int] = {
+    f: _ACT_BOOL if f in BOOL_FIELDS else _ACT_DATE if f == "apply_date" else _ACT_STR for f in TW_APP_FIELDS
+}
+
+
+def _json_text(v: Any) -> str:
+    """Compact, non-ASCII-escaped JSON text; orjson when available (stdlib json for what orjson rejects)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(v).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(v, ensure_ascii=False, separators=(",", ":"))
+
+
+def _stringify_tw_value(v: Any) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, (dict, list)):
+        return _json_text(v)
+    return str(v)
+
+
+def _tw_key_lookup(mapping: Dict[str, str]) -> Dict[Any, str]:
+    """
+    One dict resolving raw keys to standard fields. Precedence: standard field names, then exact aliases,
+    then trimmed + lower-cased aliases (the case-insensitive fallback for common variants).
+    """
+    lookup: Dict[Any, str] = {str(k).strip().lower(): v for k, v in mapping.items()}
+    lookup.update(mapping)
+    lookup.update((f, f) for f in TW_APP_FIELDS)
+    return lookup
+
+
+def _resolve_tw_key(lookup: Dict[Any, str], k: Any) -> Optional[str]:
+    target = lookup.get(k)
+    if target is None:
+        target = lookup.get(str(k).strip().lower())
+    return target
+
+
+def standardize_tw_record_rule_mapping(raw: Dict[str, Any], mapping: Dict[str, str], lookup: Optional[Dict[Any, str]] = None) -> Dict[str, Any]:
     """
     Rule-mapping only (dictionary alias -> standard field). Extra keys ignored.
+    Pass `lookup` (from _tw_key_lookup) when standardizing many records against the same mapping.
     """
+    if lookup is None:
+        lookup = _tw_key_lookup(mapping)
+    # Called once per uploaded row: bind the helpers as locals to skip the global lookups in the loops.
+    resolve, stringify, to_bool, norm_date = _resolve_tw_key, _stringify_tw_value, _to_bool, _normalize_apply_date
     out: Dict[str, Any] = {}
     # Map keys
     for k, v in (raw or {}).items():
-        if k in TW_APP_FIELDS:
-            out[k] = v
-        elif k in mapping:
-            out[mapping[k]] = v
-        else:
-            # try case-insensitive mapping for common variants
-            kk = str(k).strip()
-            if kk in mapping:
-                out[mapping[kk]] = v
-
-    # Ensure all fields exist
-    for f in TW_APP_FIELDS:
-        if f not in out:
-            out[f] = False if f in BOOL_FIELDS else ""
+        target = resolve(lookup, k)
+        if target is not None:
+            out[target] = v
 
-    # Normalize booleans
-    for bf in BOOL_FIELDS:
-        out[bf] = _to_bool(out.get(bf, False))
-
-    # Normalize apply_date
-    out["apply_date"] = _normalize_apply_date(out.get("apply_date"))
-
-    # Stringify non-string (except booleans)
-    for f in TW_APP_FIELDS:
-        if f in BOOL_FIELDS:
-            continue
+    # Single pass over the standard fields: fill missing, then apply the field's rule (bool / date / str).
+    for f, act in _FIELD_ACTION.items():
         v = out.get(f)
-        if v is None:
-            out[f] = ""
-        elif isinstance(v, (dict, list)):
-            out[f] = json.dumps(v, ensure_ascii=False)
+        if act == _ACT_STR:
+            if type(v) is not str:
+                out[f] = stringify(v)
+        elif act == _ACT_BOOL:
+            out[f] = v if v is True or v is False else to_bool(v)
         else:
-            out[f] = str(v)
+            out[f] = norm_date(v)
 
     return out
 
 
+TW_CRITICAL_FIELDS = (
+    "e_no", "case_type", "device_category", "origin", "product_class", "name_zh", "firm_name", "firm_addr",
+    "contact_name", "contact_tel", "contact_email", "manu_name", "manu_addr",
+)
+# Failure heuristic thresholds (see standardize_tw_dataset_records).
+TW_FAIL_MIN_MISSING = 7
+TW_FAIL_MIN_NONEMPTY_RAW = 3
+# Below this many records the per-row path is cheaper than building a DataFrame.
+TW_FRAME_MIN_ROWS = 64
+# Failure reports list at most this many raw keys per skipped row.
+TW_FAILURE_MAX_RAW_KEYS = 32
+
+
 def _validate_tw_record(std: Dict[str, Any]) -> List[str]:
     """
     Return missing/weak fields list (for reporting). This is not strict validation; used for failure heuristics.
+    `std` must come from standardize_tw_record_rule_mapping, which guarantees every critical field is a str.
     """
-    missing = []
-    critical = ["e_no", "case_type", "device_category", "origin", "product_class", "name_zh", "firm_name", "firm_addr", "contact_name", "contact_tel", "contact_email", "manu_name", "manu_addr"]
-    for k in critical:
-        v = std.get(k, "")
-        if isinstance(v, str) and not v.strip():
-            missing.append(k)
-    return missing
+    return [k for k in TW_CRITICAL_FIELDS if not std[k] or std[k].isspace()]
+
+
+def _nonempty_count(rec: Optional[Dict[str, Any]]) -> int:
+    """Number of raw values that are non-blank once stringified (strings are tested without a str() copy)."""
+    n = 0
+    for v in (rec or {}).values():
+        if type(v) is str:
+            if v and not v.isspace():
+                n += 1
+        elif str(v).strip():
+            n += 1
+    return n
+
+
+def _raw_keys(rec: Any) -> Tuple[Any, ...]:
+    """Leading keys of a raw record for failure reports, as a compact tuple capped at TW_FAILURE_MAX_RAW_KEYS."""
+    if not isinstance(rec, dict):
+        return ()
+    return tuple(itertools.islice(rec, TW_FAILURE_MAX_RAW_KEYS))
+
+
+def _standardize_tw_frame(records: List[Dict[str, Any]], mapping: Dict[str, str]) -> Optional[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """
+    Column-wise fast path of standardize_tw_dataset_records for uniform batches (e.g. CSV uploads):
+    every record is a dict with the same keys and no two keys map to the same field.
+    Returns None when the batch does not qualify, so the caller falls back to the per-row path.
+    """
+    first = records[0]
+    if not isinstance(first, dict) or not first:
+        return None
+    keys = first.keys()
+    if any(not isinstance(r, dict) or r.keys() != keys for r in records):
+        return None
+
+    # Resolve each raw column once instead of once per row.
+    lookup = _tw_key_lookup(mapping)
+    targets: Dict[Any, str] = {}
+    for k in keys:
+        target = _resolve_tw_key(lookup, k)
+        if target is not None:
+            targets[k] = target
+    if len(set(targets.values())) != len(targets):
+        return None  # several aliases for one field: the per-row path keeps "last key wins" semantics
+
+    raw = pd.DataFrame(records, columns=list(keys), dtype=object)
+    df = raw[list(targets)].rename(columns=targets)
+    for f, act in _FIELD_ACTION.items():
+        if f not in df.columns:
+            df[f] = False if act == _ACT_BOOL else ""
+            continue
+        col = df[f]
+        is_str = pd.api.types.infer_dtype(col, skipna=False) == "string"
+        if act == _ACT_STR:
+            if not is_str:
+                df[f] = col.map(_stringify_tw_value)
+        elif act == _ACT_BOOL:
+            df[f] = col.str.strip().str.lower().isin(_TRUTHY) if is_str else col.map(_to_bool).astype(bool)
+        else:
+            df[f] = col.map(_normalize_apply_date)
+
+    blank = df[list(TW_CRITICAL_FIELDS)].apply(lambda c: c.str.strip().eq(""))
+    candidates = blank.sum(axis=1) >= TW_FAIL_MIN_MISSING
+    failed = pd.Series(False, index=df.index)
+    if candidates.any():
+        nonempty_raw = raw.loc[candidates].apply(lambda c: c.map(str).str.strip().ne("")).sum(axis=1)
+        failed.loc[nonempty_raw.index] = nonempty_raw >= TW_FAIL_MIN_NONEMPTY_RAW
+
+    # Build the output dicts from per-column lists; much cheaper than DataFrame.to_dict(orient="records").
+    kept = df.loc[~failed]
+    cols = list(kept.columns)
+    ok = [dict(zip(cols, row)) for row in zip(*(kept[c].tolist() for c in cols))]
+    raw_keys = _raw_keys(first)  # immutable, so every failure can share it
+    failures = [
+        {
+            "row_index": int(i),
+            "reason": "Too many critical fields missing after rule mapping; skipped.",
+            "missing_fields": [c for c in TW_CRITICAL_FIELDS if row[c]],
+            "raw_keys": raw_keys,
+        }
+        for i, row in blank.loc[failed].iterrows()
+    ]
+    return ok, failures
 
 
 def standardize_tw_dataset_records(records: List[Dict[str, Any]], mapping: Dict[str, str]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
@@ -1115,40 +1694,54 @@ def standardize_tw_dataset_records(records: List[Dict[str, Any]], mapping: Dict[
       (success_records, failures)
     failures: list of {row_index, reason, missing_fields, raw_keys}
     """
+    records = records or []
+    if len(records) >= TW_FRAME_MIN_ROWS:
+        try:
+            framed = _standardize_tw_frame(records, mapping)
+        except Exception:
+            framed = None
+        if framed is not None:
+            return framed
+
+    lookup = _tw_key_lookup(mapping)
     ok = []
     failures = []
-    for i, rec in enumerate(records or []):
+    standardize, validate, keep = standardize_tw_record_rule_mapping, _validate_tw_record, ok.append
+    for i, rec in enumerate(records):
         try:
-            std = standardize_tw_record_rule_mapping(rec, mapping)
-            missing = _validate_tw_record(std)
+            std = standardize(rec, mapping, lookup)
+            missing = validate(std)
 
             # Failure heuristic: if too many criticals missing AND the record had data
-            # (prevents skipping legitimate partially-filled drafts too aggressively)
-            nonempty_raw = sum(1 for v in (rec or {}).values() if str(v).strip())
-            if nonempty_raw >= 3 and len(missing) >= 7:
+            # (prevents skipping legitimate partially-filled drafts too aggressively).
+            # The raw-value walk only runs once the cheap missing-criticals check has tripped.
+            if len(missing) >= TW_FAIL_MIN_MISSING and _nonempty_count(rec) >= TW_FAIL_MIN_NONEMPTY_RAW:
                 failures.append(
                     {
                         "row_index": i,
                         "reason": "Too many critical fields missing after rule mapping; skipped.",
                         "missing_fields": missing,
-                        "raw_keys": list((rec or {}).keys()),
+                        "raw_keys": _raw_keys(rec),
                     }
                 )
                 continue
 
-            ok.append(std)
+            keep(std)
         except Exception as e:
             failures.append(
                 {
                     "row_index": i,
                     "reason": f"Exception during standardization: {e}",
                     "missing_fields": [],
-                    "raw_keys": list((rec or {}).keys()) if isinstance(rec, dict) else [],
+                    "raw_keys": _raw_keys(rec),
                 }
             )
     return ok, failures
 
 
+CSV_CHUNK_ROWS = 10_000
+
+
 def parse_uploaded_cases_file(file) -> List[Dict[str, Any]]:
     """
     Accept JSON (object or list) or CSV (rows). Return list of dict records.
@@ -1162,18 +1755,33 @@ def parse_uploaded_cases_file(file) -> List[Dict[str, Any]]:
             return [obj]
         return []
     if name.endswith(".csv"):
-        df = pd.read_csv(file)
-        return df.fillna("").to_dict(orient="records")
+        # Read cells as text (keeps leading zeros in IDs/phone numbers, no NaN -> "" pass) and parse in
+        # chunks so only one slice of the upload is held as a DataFrame at a time.
+        records: List[Dict[str, Any]] = []
+        for chunk in pd.read_csv(file, chunksize=CSV_CHUNK_ROWS, dtype=str, keep_default_na=False):
+            cols = list(chunk.columns)
+            records.extend(dict(zip(cols, row)) for row in chunk.itertuples(index=False, name=None))
+        return records
     raise ValueError("Unsupported file type. Please upload JSON or CSV.")
 
 
 # ============================================================
 # 10) Agents YAML loading (+ standardization as in original)
 # ============================================================
-def load_agents_cfg() -> Dict[str, Any]:
+AGENTS_CFG_PATH = "agents.yaml"
+
+try:
+    _YAML_LOADER = yaml.CSafeLoader  # libyaml C loader, several times faster than pure-Python SafeLoader
+except AttributeError:
+    _YAML_LOADER = yaml.SafeLoader
+
+
+@st.cache_data(show_spinner=False)
+def _load_agents_cfg_cached(path: str, mtime: float) -> Dict[str, Any]:
+    """Parsed agents file, cached per path + mtime (cache_data hands every caller its own copy)."""
     try:
-        with open("agents.yaml", "r", encoding="utf-8") as f:
-            cfg = yaml.safe_load(f) or {}
+        with open(path, "r", encoding="utf-8") as f:
+            cfg = yaml.load(f, Loader=_YAML_LOADER) or {}
         if "agents" not in cfg:
             cfg["agents"] = {}
         return cfg
@@ -1181,124 +1789,104 @@ def load_agents_cfg() -> Dict[str, Any]:
         return {"agents": {}}
 
 
-def ensure_fallback_agents(cfg: Dict[str, Any]) -> Dict[str, Any]:
-    agents = cfg.setdefault("agents", {})
+def load_agents_cfg(path: str = AGENTS_CFG_PATH) -> Dict[str, Any]:
+    return _load_agents_cfg_cached(path, _file_mtime(path))
 
-    def put(aid: str, obj: Dict[str, Any]):
-        if aid not in agents:
-            agents[aid] = obj
 
-    put(
-        "fda_510k_intel_agent",
-        {
-            "name": "510(k) Intelligence Agent",
-            "model": "gpt-4o-mini",
-            "system_prompt": "You are an FDA 510(k) analyst.",
-            "max_tokens": 12000,
-            "category": "FDA 510(k)",
-            "description_tw": "產出 510(k) 情資/摘要與表格。",
-        },
-    )
-    put(
-        "pdf_to_markdown_agent",
-        {
-            "name": "PDF → Markdown Agent",
-            "model": "gemini-2.5-flash",
-            "system_prompt": "You convert PDF-extracted text into clean markdown.",
-            "max_tokens": 12000,
-            "category": "Document",
-            "description_tw": "將 PDF 文字轉成乾淨 Markdown。",
-        },
-    )
-    put(
-        "tw_screen_review_agent",
-        {
-            "name": "TFDA 預審形式審查代理",
-            "model": "gemini-2.5-flash",
-            "system_prompt": "You are a TFDA premarket screen reviewer.",
-            "max_tokens": 12000,
-            "category": "TFDA Premarket",
-            "description_tw": "依申請書與指引做形式審查/缺漏分析。",
-        },
-    )
-    put(
-        "tw_app_doc_helper",
-        {
-            "name": "TFDA 申請書撰寫助手",
-            "model": "gpt-4o-mini",
-            "system_prompt": "You help improve TFDA application documents.",
-            "max_tokens": 12000,
-            "category": "TFDA Premarket",
-            "description_tw": "優化申請書 Markdown 結構與語句。",
-        },
-    )
+# Agents guaranteed to exist in every config (ensure_fallback_agents copies them in when missing).
+_FALLBACK_AGENTS: Dict[str, Dict[str, Any]] = {
+    "fda_510k_intel_agent": {
+        "name": "510(k) Intelligence Agent",
+        "model": "gpt-4o-mini",
+        "system_prompt": "You are an FDA 510(k) analyst.",
+        "max_tokens": 12000,
+        "category": "FDA 510(k)",
+        "description_tw": "產出 510(k) 情資/摘要與表格。",
+    },
+    "pdf_to_markdown_agent": {
+        "name": "PDF → Markdown Agent",
+        "model": "gemini-2.5-flash",
+        "system_prompt": "You convert PDF-extracted text into clean markdown.",
+        "max_tokens": 12000,
+        "category": "Document",
+        "description_tw": "將 PDF 文字轉成乾淨 Markdown。",
+    },
+    "tw_screen_review_agent": {
+        "name": "TFDA 預審形式審查代理",
+        "model": "gemini-2.5-flash",
+        "system_prompt": "You are a TFDA premarket screen reviewer.",
+        "max_tokens": 12000,
+        "category": "TFDA Premarket",
+        "description_tw": "依申請書與指引做形式審查/缺漏分析。",
+    },
+    "tw_app_doc_helper": {
+        "name": "TFDA 申請書撰寫助手",
+        "model": "gpt-4o-mini",
+        "system_prompt": "You help improve TFDA application documents.",
+        "max_tokens": 12000,
+        "category": "TFDA Premarket",
+        "description_tw": "優化申請書 Markdown 結構與語句。",
+    },
+    "note_organizer": {
+        "name": "Note Organizer",
+        "model": "gpt-4o-mini",
+        "system_prompt": "You turn messy notes into structured markdown without adding facts.",
+        "max_tokens": 12000,
+        "category": "Note Keeper",
+        "description_tw": "把雜亂筆記整理成有標題/條列的 Markdown。",
+    },
+    "keyword_extractor": {
+        "name": "Keyword Extractor",
+        "model": "gemini-2.5-flash",
+        "system_prompt": "You extract high-signal keywords/entities from technical notes.",
+        "max_tokens": 4000,
+        "category": "Note Keeper",
+        "description_tw": "從筆記抽取高訊號關鍵字/實體。",
+    },
+    "polisher": {
+        "name": "Polisher",
+        "model": "gpt-4.1-mini",
+        "system_prompt": "You rewrite text for clarity and professional tone without changing meaning.",
+        "max_tokens": 12000,
+        "category": "Note Keeper",
+        "description_tw": "在不改變原意下潤稿，提升清晰度與專業性。",
+    },
+    "critic": {
+        "name": "Creative Critic",
+        "model": "claude-3-5-sonnet-20241022",
+        "system_prompt": "You give constructive, specific critique and improvement suggestions.",
+        "max_tokens": 12000,
+        "category": "Note Keeper",
+        "description_tw": "給出具體、可執行的建議與批判性回饋。",
+    },
+    "poet_laureate": {
+        "name": "Poet Laureate",
+        "model": "gemini-3-flash-preview",
+        "system_prompt": "You transform content into poetic or artistic prose while preserving core ideas.",
+        "max_tokens": 12000,
+        "category": "Note Keeper",
+        "description_tw": "把內容轉為詩/散文式表達（保留核心意思）。",
+    },
+    "translator": {
+        "name": "Translator",
+        "model": "gemini-2.5-flash",
+        "system_prompt": "You translate accurately with correct terminology.",
+        "max_tokens": 12000,
+        "category": "Note Keeper",
+        "description_tw": "依 UI 語言自動翻譯（中↔英）。",
+    },
+}
+_FALLBACK_AGENT_IDS = frozenset(_FALLBACK_AGENTS)
 
-    put(
-        "note_organizer",
-        {
-            "name": "Note Organizer",
-            "model": "gpt-4o-mini",
-            "system_prompt": "You turn messy notes into structured markdown without adding facts.",
-            "max_tokens": 12000,
-            "category": "Note Keeper",
-            "description_tw": "把雜亂筆記整理成有標題/條列的 Markdown。",
-        },
-    )
-    put(
-        "keyword_extractor",
-        {
-            "name": "Keyword Extractor",
-            "model": "gemini-2.5-flash",
-            "system_prompt": "You extract high-signal keywords/entities from technical notes.",
-            "max_tokens": 4000,
-            "category": "Note Keeper",
-            "description_tw": "從筆記抽取高訊號關鍵字/實體。",
-        },
-    )
-    put(
-        "polisher",
-        {
-            "name": "Polisher",
-            "model": "gpt-4.1-mini",
-            "system_prompt": "You rewrite text for clarity and professional tone without changing meaning.",
-            "max_tokens": 12000,
-            "category": "Note Keeper",
-            "description_tw": "在不改變原意下潤稿，提升清晰度與專業性。",
-        },
-    )
-    put(
-        "critic",
-        {
-            "name": "Creative Critic",
-            "model": "claude-3-5-sonnet-20241022",
-            "system_prompt": "You give constructive, specific critique and improvement suggestions.",
-            "max_tokens": 12000,
-            "category": "Note Keeper",
-            "description_tw": "給出具體、可執行的建議與批判性回饋。",
-        },
-    )
-    put(
-        "poet_laureate",
-        {
-            "name": "Poet Laureate",
-            "model": "gemini-3-flash-preview",
-            "system_prompt": "You transform content into poetic or artistic prose while preserving core ideas.",
-            "max_tokens": 12000,
-            "category": "Note Keeper",
-            "description_tw": "把內容轉為詩/散文式表達（保留核心意思）。",
-        },
-    )
-    put(
-        "translator",
-        {
-            "name": "Translator",
-            "model": "gemini-2.5-flash",
-            "system_prompt": "You translate accurately with correct terminology.",
-            "max_tokens": 12000,
-            "category": "Note Keeper",
-            "description_tw": "依 UI 語言自動翻譯（中↔英）。",
-        },
-    )
+
+def ensure_fallback_agents(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    agents = cfg.setdefault("agents", {})
+    # Runs on every rerun; nothing to add once all fallbacks are present.
+    if _FALLBACK_AGENT_IDS.issubset(agents):
+        return cfg
+    for aid, obj in _FALLBACK_AGENTS.items():
+        if aid not in agents:
+            agents[aid] = dict(obj)  # copy: session configs are edited in place
     return cfg
 
 
@@ -1308,10 +1896,7 @@ else:
     st.session_state["agents_cfg"] = ensure_fallback_agents(st.session_state["agents_cfg"])
 
 
-def standardize_agents_yaml(raw_yaml_text: str) -> Dict[str, Any]:
-    model = st.session_state.settings["model"]
-    api_keys = st.session_state.get("api_keys", {})
-    system_prompt = """
+AGENTS_STANDARDIZER_PROMPT = """
 You are a configuration Standardization Agent.
 Convert the user's uploaded agent configuration (which might be in any format) into the STANDARD format used by this system.
 
@@ -1335,18 +1920,30 @@ RULES:
 3. Ensure valid YAML output.
 4. Output ONLY the YAML, no markdown code blocks.
 """
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _standardize_agents_yaml_cached(content_digest: str, model: str, key_id: str, _raw_yaml_text: str, _api_keys: Dict[str, str]) -> Dict[str, Any]:
+    # Keyed on the SHA-256 of the upload + model + API-key digest; errors propagate and are therefore never cached.
+    out = call_llm(
+        model=model,
+        system_prompt=AGENTS_STANDARDIZER_PROMPT,
+        user_prompt=f"Raw Content:\n{_raw_yaml_text}",
+        max_tokens=8000,
+        temperature=0.0,
+        api_keys=_api_keys
+    )
+    clean_out = out.replace("```yaml", "").replace("```", "").strip()
+    return yaml.load(clean_out, Loader=_YAML_LOADER)
+
+
+def standardize_agents_yaml(raw_yaml_text: str) -> Dict[str, Any]:
+    model = st.session_state.settings["model"]
+    api_keys = st.session_state.get("api_keys", {})
+    digest = hashlib.sha256(raw_yaml_text.encode("utf-8")).hexdigest()
+    key = get_api_key(get_provider(model), api_keys)
     try:
-        out = call_llm(
-            model=model,
-            system_prompt=system_prompt,
-            user_prompt=f"Raw Content:\n{raw_yaml_text}",
-            max_tokens=8000,
-            temperature=0.0,
-            api_keys=api_keys
-        )
-        clean_out = out.replace("```yaml", "").replace("```", "").strip()
-        data = yaml.safe_load(clean_out)
-        return data
+        return _standardize_agents_yaml_cached(digest, model, _key_id(key) if key else "", raw_yaml_text, api_keys)
     except Exception as e:
         print(f"Standardization error: {e}")
         return {}
@@ -1488,7 +2085,7 @@ def render_sidebar():
         if uploaded_agents is not None:
             try:
                 raw_content = uploaded_agents.read().decode("utf-8", errors="ignore")
-                cfg = yaml.safe_load(raw_content) or {}
+                cfg = yaml.load(raw_content, Loader=_YAML_LOADER) or {}
                 if "agents" in cfg and isinstance(cfg["agents"], dict) and len(cfg["agents"]) > 0:
                     st.session_state["agents_cfg"] = ensure_fallback_agents(cfg)
                     st.success("Loaded valid agents.yaml.")
@@ -1509,9 +2106,74 @@ def render_sidebar():
 # ============================================================
 # 12) Dashboard
 # ============================================================
+def history_df_to_arrow_bytes(df: pd.DataFrame) -> bytes:
+    out = df.copy()
+    if "meta" in out.columns:
+        # meta dicts vary per event; store them as JSON text so the Arrow schema stays flat.
+        out["meta"] = out["meta"].map(lambda m: json.dumps(m or {}, ensure_ascii=False, default=str))
+    buf = BytesIO()
+    feather.write_feather(pa.Table.from_pandas(out, preserve_index=False), buf, compression="zstd")
+    return buf.getvalue()
+
+
+def history_key(hist: List[dict]) -> Tuple[int, Any]:
+    """Cheap identity for the event log: it is append-only (or cleared), so length + last timestamp suffice."""
+    if not hist:
+        return (0, None)
+    last = hist[-1]
+    return (len(hist), last.get("ts_ns", last.get("ts")))
+
+
+def _build_dashboard_charts(df: pd.DataFrame) -> Tuple[Any, Any, Any]:
+    # Imported here (~0.2s) so sessions that never log a run don't pay for altair at startup.
+    import altair as alt
+
+    chart_tab = alt.Chart(df).mark_bar().encode(
+        x=alt.X("tab:N", sort="-y"),
+        y="count():Q",
+        color="tab:N",
+        tooltip=["tab", "count()"],
+    )
+    chart_model = alt.Chart(df).mark_bar().encode(
+        x=alt.X("model:N", sort="-y"),
+        y="count():Q",
+        color="model:N",
+        tooltip=["model", "count()"],
+    )
+    chart_time = alt.Chart(df.dropna(subset=["ts"])).mark_line(point=True).encode(
+        x="ts:T",
+        y="tokens_est:Q",
+        color="tab:N",
+        tooltip=["ts", "tab", "agent", "model", "tokens_est"],
+    )
+    return chart_tab, chart_model, chart_time
+
+
+def _dashboard_charts(hist_key: Tuple[int, Any], df: pd.DataFrame) -> Tuple[Any, Any, Any]:
+    """
+    Altair specs for the status wall, memoized in this session's state and rebuilt only when the history
+    changes (not on unrelated reruns such as a theme toggle).
+    """
+    cached = st.session_state.get("_dashboard_charts")
+    if cached is None or cached[0] != hist_key:
+        cached = (hist_key, _build_dashboard_charts(df))
+        st.session_state["_dashboard_charts"] = cached
+    return cached[1]
+
+
+def _history_frame(hist: List[dict]) -> pd.DataFrame:
+    """history_to_df memoized in session state per history_key(); callers treat the frame as read-only."""
+    key = history_key(hist)
+    cached = st.session_state.get("_history_frame")
+    if cached is None or cached[0] != key:
+        cached = (key, history_to_df(hist))
+        st.session_state["_history_frame"] = cached
+    return cached[1]
+
+
 def render_dashboard():
     hist = st.session_state["history"]
-    df = pd.DataFrame(hist) if hist else pd.DataFrame(columns=["tab", "agent", "model", "tokens_est", "ts"])
+    df = _history_frame(hist)
     total_runs = int(len(df))
     tokens_total = int(df["tokens_est"].sum()) if total_runs else 0
     unique_models = int(df["model"].nunique()) if total_runs else 0
@@ -1560,8 +2222,7 @@ def render_dashboard():
         st.info("No runs yet. Start by running an agent, a workflow step, or a note magic.")
         return
 
-    df2 = df.copy()
-    df2["ts"] = pd.to_datetime(df2["ts"], errors="coerce")
+    df2 = df
     last = df2.sort_values("ts", ascending=False).iloc[0]
 
     severity_grad = "linear-gradient(135deg,#22c55e,#16a34a)"
@@ -1586,34 +2247,18 @@ def render_dashboard():
         unsafe_allow_html=True,
     )
 
+    chart_tab, chart_model, chart_time = _dashboard_charts(history_key(hist), df2)
+
     cA, cB = st.columns(2)
     with cA:
         st.markdown("#### Runs by Tab")
-        chart_tab = alt.Chart(df2).mark_bar().encode(
-            x=alt.X("tab:N", sort="-y"),
-            y="count():Q",
-            color="tab:N",
-            tooltip=["tab", "count()"],
-        )
         st.altair_chart(chart_tab, use_container_width=True)
 
     with cB:
         st.markdown("#### Runs by Model")
-        chart_model = alt.Chart(df2).mark_bar().encode(
-            x=alt.X("model:N", sort="-y"),
-            y="count():Q",
-            color="model:N",
-            tooltip=["model", "count()"],
-        )
         st.altair_chart(chart_model, use_container_width=True)
 
     st.markdown("#### Token Usage Over Time")
-    chart_time = alt.Chart(df2.dropna(subset=["ts"])).mark_line(point=True).encode(
-        x="ts:T",
-        y="tokens_est:Q",
-        color="tab:N",
-        tooltip=["ts", "tab", "agent", "model", "tokens_est"],
-    )
     st.altair_chart(chart_time, use_container_width=True)
 
     st.markdown("#### Recent Activity")
@@ -1625,13 +2270,29 @@ def render_dashboard():
             st.session_state["history"] = []
             st.rerun()
     with cY:
-        csv_bytes = df2.to_csv(index=False).encode("utf-8")
-        st.download_button(t("export_history"), data=csv_bytes, file_name="antigravity_history.csv", mime="text/csv")
+        # Only the selected format is serialized on each rerun; Arrow (zstd) is the default when pyarrow is present.
+        formats = ["Arrow", "CSV"] if feather else ["CSV"]
+        fmt = st.radio("Export format", formats, horizontal=True, key="history_export_fmt")
+        if fmt == "Arrow":
+            st.download_button(t("export_history_arrow"), data=history_df_to_arrow_bytes(df2), file_name="antigravity_history.arrow", mime="application/vnd.apache.arrow.file")
+        else:
+            csv_bytes = df2.to_csv(index=False).encode("utf-8")
+            st.download_button(t("export_history"), data=csv_bytes, file_name="antigravity_history.csv", mime="text/csv")
 
 
 # ============================================================
 # 13) Agent runner UI (kept)
 # ============================================================
+def agent_model_choices(agent_cfg: Dict[str, Any]) -> List[str]:
+    """
+    ALL_MODELS narrowed to the agent's supported_models (all of them when unset or nothing matches).
+    """
+    supported = agent_cfg.get("supported_models", None)
+    if not isinstance(supported, list) or not supported:
+        return ALL_MODELS
+    return [m for m in ALL_MODELS if m in supported] or ALL_MODELS
+
+
 def agent_run_ui(
     agent_id: str,
     tab_key: str,
@@ -1649,10 +2310,7 @@ def agent_run_ui(
     base_max_tokens = int(agent_cfg.get("max_tokens", st.session_state.settings["max_tokens"]))
     system_prompt = agent_cfg.get("system_prompt", "")
 
-    supported = agent_cfg.get("supported_models", None)
-    model_choices = ALL_MODELS
-    if isinstance(supported, list) and supported:
-        model_choices = [m for m in ALL_MODELS if m in supported] or ALL_MODELS
+    model_choices = agent_model_choices(agent_cfg)
 
     status_key = f"{tab_key}_status"
     if status_key not in st.session_state:
@@ -1704,7 +2362,7 @@ def agent_run_ui(
                 st.session_state[status_key] = "done"
                 st.session_state[f"{tab_key}_output_edited"] = out
                 st.rerun()  # 建議
-                token_est = est_tokens(user_full + out)
+                token_est = est_tokens(user_full + out, model)
                 log_event(tab_label_for_history or tab_key, agent_name, model, token_est, meta={"agent_id": agent_id})
             except Exception as e:
                 st.session_state[status_key] = "error"
@@ -1743,6 +2401,190 @@ def workflow_default_steps() -> List[Dict[str, Any]]:
     ]
 
 
+def _workflow_step_request(wf: Dict[str, Any], idx: int, step_input: str, agents_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """call_llm / submit_llm_batch keyword arguments for workflow step `idx` run on `step_input`."""
+    step = wf["steps"][idx]
+    return {
+        "model": step["model"],
+        "system_prompt": agents_dict.get(step.get("agent_id", ""), {}).get("system_prompt", ""),
+        "user_prompt": ((step.get("prompt") or "").strip() + "\n\n---\n\n" + (step_input or "")).strip(),
+        "max_tokens": int(step["max_tokens"]),
+        "temperature": float(st.session_state.settings["temperature"]),
+        "api_keys": st.session_state.get("api_keys", {}),
+    }
+
+
+def _store_workflow_output(wf: Dict[str, Any], idx: int, out: str) -> None:
+    wf["outputs"][idx] = out
+    wf["statuses"][idx] = "done"
+    # Keyed text areas keep their own state and ignore a changed `value=`; push the result into the
+    # step's output box and the next step's input box (neither is rendered yet in this run).
+    st.session_state[f"wf_out_{idx}"] = out
+    if idx + 1 < len(wf["steps"]):
+        st.session_state[f"wf_input_{idx + 1}"] = out
+
+
+def _log_workflow_step(wf: Dict[str, Any], idx: int, model: str, user_prompt: str, out: str) -> None:
+    step = wf["steps"][idx]
+    agent_id = step.get("agent_id", "")
+    log_event("Workflow Studio", step.get("name", agent_id), model, est_tokens(user_prompt + out, model), meta={"agent_id": agent_id, "workflow_step": idx + 1})
+
+
+def run_workflow_step(
+    wf: Dict[str, Any],
+    idx: int,
+    step_input: str,
+    agents_dict: Dict[str, Any],
+    done: Optional[Dict[Tuple[Any, ...], str]] = None,
+    use_cache: bool = False,
+) -> str:
+    """
+    Run workflow step `idx` on `step_input`, store its output/status in `wf` and return the output.
+    The reply streams onto the page; with `use_cache` an identical earlier request (within the hour) is
+    reused instead, without streaming.
+    `done` coalesces steps whose (model, system prompt, user prompt, max_tokens) match an earlier step of
+    the same batch run, so an identical call is only sent once.
+    """
+    req = _workflow_step_request(wf, idx, step_input, agents_dict)
+    sig = (req["model"], req["system_prompt"], req["user_prompt"], req["max_tokens"])
+
+    wf["statuses"][idx] = "thinking"
+    if done is not None and sig in done:
+        out = done[sig]
+    else:
+        try:
+            out = call_llm_cached(**req) if use_cache else write_llm_stream(**req)
+        except Exception:
+            wf["statuses"][idx] = "error"
+            raise
+        if done is not None:
+            done[sig] = out
+        _log_workflow_step(wf, idx, req["model"], req["user_prompt"], out)
+    _store_workflow_output(wf, idx, out)
+    return out
+
+
+def submit_workflow_batch(wf: Dict[str, Any], idx: int, step_input: str, agents_dict: Dict[str, Any]) -> None:
+    """Queue workflow step `idx` on its provider's Batch API; collect_workflow_batch fills in the output later."""
+    req = _workflow_step_request(wf, idx, step_input, agents_dict)
+    try:
+        handle = submit_llm_batch(**req)
+    except Exception:
+        wf["statuses"][idx] = "error"
+        raise
+    wf.setdefault("batches", {})[idx] = {**handle, "model": req["model"], "user_prompt": req["user_prompt"]}
+    wf["statuses"][idx] = "queued"
+
+
+def collect_workflow_batch(wf: Dict[str, Any], idx: int) -> bool:
+    """Store the queued batch result of step `idx` if the provider has finished it; False while still pending."""
+    pending = wf["batches"][idx]
+    try:
+        out = poll_llm_batch(pending, st.session_state.get("api_keys", {}))
+    except Exception:
+        wf["statuses"][idx] = "error"
+        del wf["batches"][idx]
+        raise
+    if out is None:
+        return False
+    del wf["batches"][idx]
+    _log_workflow_step(wf, idx, pending["model"], pending["user_prompt"], out)
+    _store_workflow_output(wf, idx, out)
+    return True
+
+
+def _sync_workflow_input() -> None:
+    # The workflow input feeds step 1; its keyed input box would otherwise keep the old text.
+    st.session_state["wf_input_0"] = st.session_state["wf_input_text"]
+
+
+@st.fragment
+def _render_workflow_step(idx: int) -> None:
+    """
+    One Workflow Studio step. A fragment, so editing or running a step reruns only this step's widgets;
+    a successful run triggers a full rerun to refresh the next step's input and the dashboard.
+    """
+    agents_dict = st.session_state["agents_cfg"].get("agents", {})
+    wf = st.session_state["workflow"]
+    step = wf["steps"][idx]
+    agent_id = step.get("agent_id", "")
+    agent_cfg = agents_dict.get(agent_id, {})
+    agent_name = step.get("name") or agent_cfg.get("name") or agent_id
+
+    with st.expander(f"{t('step')} {idx+1}: {agent_name}  ·  ({agent_id})", expanded=(idx == wf["cursor"])):
+        wf["statuses"][idx] = wf["statuses"][idx] if idx < len(wf["statuses"]) else "idle"
+        status_row(f"{agent_name}", wf["statuses"][idx])
+
+        cA, cB = st.columns([1.2, 1.2])
+        with cA:
+            agent_ids = sorted(agents_dict)
+            step["agent_id"] = st.selectbox("agent_id", agent_ids, index=agent_ids.index(agent_id) if agent_id in agents_dict else 0, key=f"wf_agent_{idx}")
+        with cB:
+            agent_id = step["agent_id"]
+            agent_cfg = agents_dict.get(agent_id, {})
+            model_choices = agent_model_choices(agent_cfg)
+            step["model"] = st.selectbox(t("model"), model_choices, index=model_choices.index(step.get("model")) if step.get("model") in model_choices else 0, key=f"wf_model_{idx}")
+
+        cC, cD = st.columns([1.2, 1.2])
+        with cC:
+            step["max_tokens"] = st.number_input("max_tokens", min_value=1000, max_value=120000, value=int(step.get("max_tokens", st.session_state.settings["max_tokens"])), step=1000, key=f"wf_mt_{idx}")
+        with cD:
+            step["name"] = st.text_input("Display name", value=str(step.get("name") or agent_cfg.get("name") or agent_id), key=f"wf_name_{idx}")
+
+        step["prompt"] = st.text_area(t("prompt"), value=step.get("prompt", ""), height=150, key=f"wf_prompt_{idx}")
+
+        if idx == 0:
+            step_input_default = wf.get("input", "")
+        else:
+            step_input_default = wf["outputs"][idx - 1] or ""
+
+        step_input = st.text_area(f"{t('input_text')} (Step {idx+1})", value=step_input_default, height=180, key=f"wf_input_{idx}")
+
+        use_batch = get_provider(step["model"]) in BATCH_PROVIDERS and st.checkbox(
+            "Background batch (~50% cheaper; results can take minutes to hours)", key=f"wf_batch_{idx}"
+        )
+
+        cR1, cR2 = st.columns([1.0, 1.0])
+        run_step = cR1.button(f"▶ {t('run_step')} {idx+1}", key=f"wf_run_{idx}")
+        run_next = cR2.button(f"⏭ {t('run_next')} {idx+1}", key=f"wf_run_next_{idx}")
+
+        if (run_step or run_next) and use_batch:
+            wf["cursor"] = idx
+            try:
+                submit_workflow_batch(wf, idx, step_input, agents_dict)
+            except Exception as e:
+                st.error(f"Workflow step error: {e}")
+        elif run_step or run_next:
+            wf["cursor"] = idx
+            try:
+                use_cache = bool(st.session_state.get("wf_use_cache", False))
+                if use_cache:
+                    with st.spinner(f"Running step {idx+1}..."):
+                        run_workflow_step(wf, idx, step_input, agents_dict, use_cache=True)
+                else:
+                    run_workflow_step(wf, idx, step_input, agents_dict)  # streams the reply below the buttons
+                if run_next and idx < len(wf["steps"]) - 1:
+                    wf["cursor"] = idx + 1
+                st.rerun()
+            except Exception as e:
+                st.error(f"Workflow step error: {e}")
+
+        pending = wf.get("batches", {}).get(idx)
+        if pending:
+            st.caption(f"Queued on the {pending['provider']} Batch API: `{pending['batch_id']}`")
+            if st.button("🔄 Check batch", key=f"wf_batch_check_{idx}"):
+                try:
+                    if collect_workflow_batch(wf, idx):
+                        st.rerun()
+                    st.info("Batch is still processing; check again later.")
+                except Exception as e:
+                    st.error(f"Workflow step error: {e}")
+
+        st.markdown(f"**{t('workflow_output')} (editable; becomes input to next step)**")
+        view = st.radio(t("view_mode"), [t("markdown"), t("plain_text")], horizontal=True, key=f"wf_view_{idx}")
+        wf["outputs"][idx] = st.text_area(f"Output (Step {idx+1})", value=wf["outputs"][idx] or "", height=240, key=f"wf_out_{idx}")
+
+
 def render_workflow_studio():
     st.markdown(f"## {t('workflow_studio')}")
     st.caption("Run agents step-by-step. Edit prompt/model/max_tokens BEFORE each step. Edit output, then pass to next agent.")
@@ -1763,6 +2605,7 @@ def render_workflow_studio():
             wf["statuses"] = ["idle"] * len(wf["steps"])
             wf["cursor"] = 0
             wf["input"] = ""
+            wf["batches"] = {}
             st.rerun()
     with c1:
         if st.button(t("add_step")):
@@ -1778,6 +2621,7 @@ def render_workflow_studio():
                 wf["steps"].pop()
                 wf["outputs"].pop()
                 wf["statuses"].pop()
+                wf.get("batches", {}).pop(len(wf["steps"]), None)
                 wf["cursor"] = min(wf["cursor"], len(wf["steps"]) - 1)
                 st.rerun()
     with c3:
@@ -1785,86 +2629,31 @@ def render_workflow_studio():
 
     st.markdown("---")
     st.markdown(f"### {t('workflow_input')}")
-    wf["input"] = st.text_area(t("input_text"), value=wf.get("input", ""), height=200, key="wf_input_text")
+    wf["input"] = st.text_area(t("input_text"), value=wf.get("input", ""), height=200, key="wf_input_text", on_change=_sync_workflow_input)
+
+    start = int(wf["cursor"])
+    cRun, cCache, cClear = st.columns([1.6, 1.2, 1.0])
+    use_cache = cCache.checkbox("Reuse cached outputs", key="wf_use_cache", help="Identical step runs reuse the output from the last hour instead of calling the model again.")
+    if cClear.button("🗑 Clear cache", key="wf_clear_llm_cache"):
+        _cached_call_llm.clear()
+    if cRun.button(f"⏩ {t('run_remaining')} ({t('step')} {start+1}–{len(wf['steps'])})", key="wf_run_remaining"):
+        # One script run for the whole chain instead of a click + rerun per step.
+        # The first step takes its (possibly edited) input box; each later step takes the previous output.
+        step_input = st.session_state.get(f"wf_input_{start}", wf["input"] if start == 0 else wf["outputs"][start - 1]) or ""
+        done: Dict[Tuple[Any, ...], str] = {}
+        try:
+            with st.spinner(f"Running steps {start+1}–{len(wf['steps'])}..."):
+                for idx in range(start, len(wf["steps"])):
+                    wf["cursor"] = idx
+                    step_input = run_workflow_step(wf, idx, step_input, agents_dict, done, use_cache=use_cache)
+            st.rerun()
+        except Exception as e:
+            st.error(f"Workflow step error: {e}")
 
     st.markdown("---")
     st.markdown(f"### {t('step')}s")
-    for idx, step in enumerate(wf["steps"]):
-        agent_id = step.get("agent_id", "")
-        agent_cfg = agents_dict.get(agent_id, {})
-        agent_name = step.get("name") or agent_cfg.get("name") or agent_id
-
-        with st.expander(f"{t('step')} {idx+1}: {agent_name}  ·  ({agent_id})", expanded=(idx == wf["cursor"])):
-            wf["statuses"][idx] = wf["statuses"][idx] if idx < len(wf["statuses"]) else "idle"
-            status_row(f"{agent_name}", wf["statuses"][idx])
-
-            supported = agent_cfg.get("supported_models", None)
-            model_choices = ALL_MODELS
-            if isinstance(supported, list) and supported:
-                model_choices = [m for m in ALL_MODELS if m in supported] or ALL_MODELS
-
-            cA, cB = st.columns([1.2, 1.2])
-            with cA:
-                step["agent_id"] = st.selectbox("agent_id", sorted(list(agents_dict.keys())), index=sorted(list(agents_dict.keys())).index(agent_id) if agent_id in agents_dict else 0, key=f"wf_agent_{idx}")
-            with cB:
-                agent_id = step["agent_id"]
-                agent_cfg = agents_dict.get(agent_id, {})
-                supported = agent_cfg.get("supported_models", None)
-                model_choices = ALL_MODELS
-                if isinstance(supported, list) and supported:
-                    model_choices = [m for m in ALL_MODELS if m in supported] or ALL_MODELS
-                step["model"] = st.selectbox(t("model"), model_choices, index=model_choices.index(step.get("model")) if step.get("model") in model_choices else 0, key=f"wf_model_{idx}")
-
-            cC, cD = st.columns([1.2, 1.2])
-            with cC:
-                step["max_tokens"] = st.number_input("max_tokens", min_value=1000, max_value=120000, value=int(step.get("max_tokens", st.session_state.settings["max_tokens"])), step=1000, key=f"wf_mt_{idx}")
-            with cD:
-                step["name"] = st.text_input("Display name", value=str(step.get("name") or agent_cfg.get("name") or agent_id), key=f"wf_name_{idx}")
-
-            step["prompt"] = st.text_area(t("prompt"), value=step.get("prompt", ""), height=150, key=f"wf_prompt_{idx}")
-
-            if idx == 0:
-                step_input_default = wf.get("input", "")
-            else:
-                step_input_default = wf["outputs"][idx - 1] or ""
-
-            step_input = st.text_area(f"{t('input_text')} (Step {idx+1})", value=step_input_default, height=180, key=f"wf_input_{idx}")
-
-            cR1, cR2 = st.columns([1.0, 1.0])
-            run_step = cR1.button(f"▶ {t('run_step')} {idx+1}", key=f"wf_run_{idx}")
-            run_next = cR2.button(f"⏭ {t('run_next')} {idx+1}", key=f"wf_run_next_{idx}")
-
-            if run_step or run_next:
-                wf["cursor"] = idx
-                wf["statuses"][idx] = "thinking"
-                agent_cfg = agents_dict.get(agent_id, {})
-                system_prompt = agent_cfg.get("system_prompt", "")
-                user_prompt = (step.get("prompt") or "").strip()
-                user_full = (user_prompt + "\n\n---\n\n" + (step_input or "")).strip()
-
-                try:
-                    with st.spinner(f"Running step {idx+1}..."):
-                        out = call_llm(
-                            model=step["model"],
-                            system_prompt=system_prompt,
-                            user_prompt=user_full,
-                            max_tokens=int(step["max_tokens"]),
-                            temperature=float(st.session_state.settings["temperature"]),
-                            api_keys=st.session_state.get("api_keys", {}),
-                        )
-                    wf["outputs"][idx] = out
-                    wf["statuses"][idx] = "done"
-                    log_event("Workflow Studio", step.get("name", agent_id), step["model"], est_tokens(user_full + out), meta={"agent_id": agent_id, "workflow_step": idx + 1})
-                    if run_next and idx < len(wf["steps"]) - 1:
-                        wf["cursor"] = idx + 1
-                        st.rerun()
-                except Exception as e:
-                    wf["statuses"][idx] = "error"
-                    st.error(f"Workflow step error: {e}")
-
-            st.markdown(f"**{t('workflow_output')} (editable; becomes input to next step)**")
-            view = st.radio(t("view_mode"), [t("markdown"), t("plain_text")], horizontal=True, key=f"wf_view_{idx}")
-            wf["outputs"][idx] = st.text_area(f"Output (Step {idx+1})", value=wf["outputs"][idx] or "", height=240, key=f"wf_out_{idx}")
+    for idx in range(len(wf["steps"])):
+        _render_workflow_step(idx)
 
     st.markdown("---")
     final_out = wf["outputs"][-1] if wf["outputs"] else ""
@@ -1876,164 +2665,77 @@ def render_workflow_studio():
 # 15) TW Premarket helpers: session <-> dict
 # ============================================================
 def build_tw_app_dict_from_session() -> dict:
-    s = st.session_state
-    apply_date_val = s.get("tw_apply_date")
-    apply_date_str = apply_date_val.strftime("%Y-%m-%d") if isinstance(apply_date_val, (datetime, date)) else ""
-    return {
-        "doc_no": s.get("tw_doc_no", ""),
-        "e_no": s.get("tw_e_no", ""),
-        "apply_date": apply_date_str,
-        "case_type": s.get("tw_case_type", ""),
-        "device_category": s.get("tw_device_category", ""),
-        "case_kind": s.get("tw_case_kind", ""),
-        "origin": s.get("tw_origin", ""),
-        "product_class": s.get("tw_product_class", ""),
-        "similar": s.get("tw_similar", ""),
-        "replace_flag": s.get("tw_replace_flag", ""),
-        "prior_app_no": s.get("tw_prior_app_no", ""),
-        "name_zh": s.get("tw_dev_name_zh", ""),
-        "name_en": s.get("tw_dev_name_en", ""),
-        "indications": s.get("tw_indications", ""),
-        "spec_comp": s.get("tw_spec_comp", ""),
-        "main_cat": s.get("tw_main_cat", ""),
-        "item_code": s.get("tw_item_code", ""),
-        "item_name": s.get("tw_item_name", ""),
-        "uniform_id": s.get("tw_uniform_id", ""),
-        "firm_name": s.get("tw_firm_name", ""),
-        "firm_addr": s.get("tw_firm_addr", ""),
-        "resp_name": s.get("tw_resp_name", ""),
-        "contact_name": s.get("tw_contact_name", ""),
-        "contact_tel": s.get("tw_contact_tel", ""),
-        "contact_fax": s.get("tw_contact_fax", ""),
-        "contact_email": s.get("tw_contact_email", ""),
-        "confirm_match": bool(s.get("tw_confirm_match", False)),
-        "cert_raps": bool(s.get("tw_cert_raps", False)),
-        "cert_ahwp": bool(s.get("tw_cert_ahwp", False)),
-        "cert_other": s.get("tw_cert_other", ""),
-        "manu_type": s.get("tw_manu_type", ""),
-        "manu_name": s.get("tw_manu_name", ""),
-        "manu_country": s.get("tw_manu_country", ""),
-        "manu_addr": s.get("tw_manu_addr", ""),
-        "manu_note": s.get("tw_manu_note", ""),
-        "auth_applicable": s.get("tw_auth_app", ""),
-        "auth_desc": s.get("tw_auth_desc", ""),
-        "cfs_applicable": s.get("tw_cfs_app", ""),
-        "cfs_desc": s.get("tw_cfs_desc", ""),
-        "qms_applicable": s.get("tw_qms_app", ""),
-        "qms_desc": s.get("tw_qms_desc", ""),
-        "similar_info": s.get("tw_similar_info", ""),
-        "labeling_info": s.get("tw_labeling_info", ""),
-        "tech_file_info": s.get("tw_tech_file_info", ""),
-        "preclinical_info": s.get("tw_preclinical_info", ""),
-        "preclinical_replace": s.get("tw_preclinical_replace", ""),
-        "clinical_just": s.get("tw_clinical_app", ""),
-        "clinical_info": s.get("tw_clinical_info", ""),
-    }
+    sget = st.session_state.get
+    out = {f: sget(key, "") for f, key in TW_APP_SESSION_KEYS}
+    apply_date_val = out["apply_date"]
+    out["apply_date"] = apply_date_val.strftime("%Y-%m-%d") if isinstance(apply_date_val, (datetime, date)) else ""
+    for f in BOOL_FIELDS:
+        out[f] = bool(out[f])
+    return out
 
 
 def apply_tw_app_dict_to_session(data: dict):
     s = st.session_state
-    s["tw_doc_no"] = data.get("doc_no", "")
-    s["tw_e_no"] = data.get("e_no", "")
-    try:
-        if data.get("apply_date"):
-            y, m, d = map(int, str(data["apply_date"]).split("-"))
-            s["tw_apply_date"] = date(y, m, d)
-    except Exception:
-        pass
-    s["tw_case_type"] = data.get("case_type", "")
-    s["tw_device_category"] = data.get("device_category", "")
-    s["tw_case_kind"] = data.get("case_kind", "")
-    s["tw_origin"] = data.get("origin", "")
-    s["tw_product_class"] = data.get("product_class", "")
-    s["tw_similar"] = data.get("similar", "")
-    s["tw_replace_flag"] = data.get("replace_flag", "")
-    s["tw_prior_app_no"] = data.get("prior_app_no", "")
-    s["tw_dev_name_zh"] = data.get("name_zh", "")
-    s["tw_dev_name_en"] = data.get("name_en", "")
-    s["tw_indications"] = data.get("indications", "")
-    s["tw_spec_comp"] = data.get("spec_comp", "")
-    s["tw_main_cat"] = data.get("main_cat", "")
-    s["tw_item_code"] = data.get("item_code", "")
-    s["tw_item_name"] = data.get("item_name", "")
-    s["tw_uniform_id"] = data.get("uniform_id", "")
-    s["tw_firm_name"] = data.get("firm_name", "")
-    s["tw_firm_addr"] = data.get("firm_addr", "")
-    s["tw_resp_name"] = data.get("resp_name", "")
-    s["tw_contact_name"] = data.get("contact_name", "")
-    s["tw_contact_tel"] = data.get("contact_tel", "")
-    s["tw_contact_fax"] = data.get("contact_fax", "")
-    s["tw_contact_email"] = data.get("contact_email", "")
-    s["tw_confirm_match"] = bool(data.get("confirm_match", False))
-    s["tw_cert_raps"] = bool(data.get("cert_raps", False))
-    s["tw_cert_ahwp"] = bool(data.get("cert_ahwp", False))
-    s["tw_cert_other"] = data.get("cert_other", "")
-    s["tw_manu_type"] = data.get("manu_type", "")
-    s["tw_manu_name"] = data.get("manu_name", "")
-    s["tw_manu_country"] = data.get("manu_country", "")
-    s["tw_manu_addr"] = data.get("manu_addr", "")
-    s["tw_manu_note"] = data.get("manu_note", "")
-    s["tw_auth_app"] = data.get("auth_applicable", "")
-    s["tw_auth_desc"] = data.get("auth_desc", "")
-    s["tw_cfs_app"] = data.get("cfs_applicable", "")
-    s["tw_cfs_desc"] = data.get("cfs_desc", "")
-    s["tw_qms_app"] = data.get("qms_applicable", "")
-    s["tw_qms_desc"] = data.get("qms_desc", "")
-    s["tw_similar_info"] = data.get("similar_info", "")
-    s["tw_labeling_info"] = data.get("labeling_info", "")
-    s["tw_tech_file_info"] = data.get("tech_file_info", "")
-    s["tw_preclinical_info"] = data.get("preclinical_info", "")
-    s["tw_preclinical_replace"] = data.get("preclinical_replace", "")
-    s["tw_clinical_app"] = data.get("clinical_just", "")
-    s["tw_clinical_info"] = data.get("clinical_info", "")
+    for f, key in TW_APP_SESSION_KEYS:
+        if f in BOOL_FIELDS:
+            s[key] = bool(data.get(f, False))
+        elif f != "apply_date":
+            s[key] = data.get(f, "")
+    # Table edits arrive unstandardized, so accept the same date forms as the dataset normalizer.
+    iso_date = _normalize_apply_date(data.get("apply_date"))
+    if iso_date:
+        s["tw_apply_date"] = date.fromisoformat(iso_date)
+
+
+# Required application fields as (label shown in the missing-items report, session key).
+TW_REQUIRED_APP_FIELDS = (
+    ("電子流水號", "tw_e_no"),
+    ("案件類型", "tw_case_type"),
+    ("醫療器材類型", "tw_device_category"),
+    ("產地", "tw_origin"),
+    ("產品等級", "tw_product_class"),
+    ("中文名稱", "tw_dev_name_zh"),
+    ("英文名稱", "tw_dev_name_en"),
+    ("統一編號", "tw_uniform_id"),
+    ("醫療器材商名稱", "tw_firm_name"),
+    ("醫療器材商地址", "tw_firm_addr"),
+    ("負責人姓名", "tw_resp_name"),
+    ("聯絡人姓名", "tw_contact_name"),
+    ("電話", "tw_contact_tel"),
+    ("電子郵件", "tw_contact_email"),
+    ("製造廠名稱", "tw_manu_name"),
+    ("製造廠地址", "tw_manu_addr"),
+)
 
 
-def compute_tw_app_completeness() -> float:
-    s = st.session_state
-    required_keys = [
-        "tw_e_no", "tw_case_type", "tw_device_category",
-        "tw_origin", "tw_product_class",
-        "tw_dev_name_zh", "tw_dev_name_en",
-        "tw_uniform_id", "tw_firm_name", "tw_firm_addr",
-        "tw_resp_name", "tw_contact_name", "tw_contact_tel",
-        "tw_contact_email",
-        "tw_manu_name", "tw_manu_addr",
-    ]
+def _scan_tw_required_fields() -> Tuple[int, List[str]]:
+    """
+    Single pass over TW_REQUIRED_APP_FIELDS: (number filled, labels of blank text fields).
+    Non-text values count as filled when truthy and are never reported as missing.
+    """
+    sget = st.session_state.get
     filled = 0
-    for k in required_keys:
-        v = s.get(k, "")
+    missing = []
+    for label, key in TW_REQUIRED_APP_FIELDS:
+        v = sget(key, "")
         if isinstance(v, str):
-            filled += 1 if v.strip() else 0
-        else:
-            filled += 1 if v else 0
-    return filled / len(required_keys) if required_keys else 0.0
+            if v.strip():
+                filled += 1
+            else:
+                missing.append(label)
+        elif v:
+            filled += 1
+    return filled, missing
+
+
+def compute_tw_app_completeness() -> float:
+    filled, _ = _scan_tw_required_fields()
+    return filled / len(TW_REQUIRED_APP_FIELDS)
 
 
 def compute_tw_missing_items_report() -> Dict[str, Any]:
     s = st.session_state
-    missing_required = []
-    required_keys = [
-        ("電子流水號", "tw_e_no"),
-        ("案件類型", "tw_case_type"),
-        ("醫療器材類型", "tw_device_category"),
-        ("產地", "tw_origin"),
-        ("產品等級", "tw_product_class"),
-        ("中文名稱", "tw_dev_name_zh"),
-        ("英文名稱", "tw_dev_name_en"),
-        ("統一編號", "tw_uniform_id"),
-        ("醫療器材商名稱", "tw_firm_name"),
-        ("醫療器材商地址", "tw_firm_addr"),
-        ("負責人姓名", "tw_resp_name"),
-        ("聯絡人姓名", "tw_contact_name"),
-        ("電話", "tw_contact_tel"),
-        ("電子郵件", "tw_contact_email"),
-        ("製造廠名稱", "tw_manu_name"),
-        ("製造廠地址", "tw_manu_addr"),
-    ]
-    for label, key in required_keys:
-        v = s.get(key, "")
-        if isinstance(v, str) and not v.strip():
-            missing_required.append(label)
+    _, missing_required = _scan_tw_required_fields()
 
     guidance_md = (s.get("tw_guidance_effective_md") or "").strip()
     guidance_notes = []
@@ -2078,20 +2780,23 @@ def apply_company_to_case(case: Dict[str, Any], company: Dict[str, Any]) -> Dict
 # 17) TW Field Mapping Dictionary Editor (upload/download/edit)
 # ============================================================
 def mapping_dict_to_df(mapping: Dict[str, str]) -> pd.DataFrame:
-    items = [{"alias": k, "standard_key": v} for k, v in (mapping or {}).items()]
-    return pd.DataFrame(items).sort_values(["standard_key", "alias"], kind="stable")
+    m = mapping or {}
+    df = pd.DataFrame({"alias": list(m.keys()), "standard_key": list(m.values())})
+    return df.sort_values(["standard_key", "alias"], kind="stable", ignore_index=True)
+
+
+def _clean_text_column(col: pd.Series) -> pd.Series:
+    # Blank cells (None/NaN, e.g. rows added in the data editor) become "" rather than "None"/"nan".
+    return col.fillna("").astype(str).str.strip()
 
 
 def df_to_mapping_dict(df: pd.DataFrame) -> Dict[str, str]:
-    out = {}
-    if df is None or df.empty:
-        return out
-    for _, row in df.iterrows():
-        a = str(row.get("alias", "")).strip()
-        s = str(row.get("standard_key", "")).strip()
-        if a and s:
-            out[a] = s
-    return out
+    if df is None or df.empty or "alias" not in df.columns or "standard_key" not in df.columns:
+        return {}
+    a = _clean_text_column(df["alias"])
+    s = _clean_text_column(df["standard_key"])
+    keep = (a != "") & (s != "")
+    return dict(zip(a[keep].tolist(), s[keep].tolist()))
 
 
 def parse_mapping_upload(file) -> Dict[str, str]:
@@ -2109,15 +2814,14 @@ def parse_mapping_upload(file) -> Dict[str, str]:
             return out
         return {}
     if name.endswith(".csv"):
-        df = pd.read_csv(file).fillna("")
+        # Read every cell as text: aliases like "01" stay as written and there is no NaN pass to undo.
+        df = pd.read_csv(file, dtype=str, na_filter=False)
         if "alias" in df.columns and "standard_key" in df.columns:
             return df_to_mapping_dict(df)
         # accept two-column CSV
         if len(df.columns) >= 2:
-            out = {}
-            for _, r in df.iterrows():
-                out[str(r[df.columns[0]]).strip()] = str(r[df.columns[1]]).strip()
-            return out
+            c0, c1 = df.columns[:2]
+            return dict(zip(df[c0].str.strip().tolist(), df[c1].str.strip().tolist()))
         return {}
     raise ValueError("Unsupported mapping file type (JSON/CSV).")
 
@@ -2161,7 +2865,9 @@ def render_tw_premarket_tab():
                 
                 if st.button("Load selected default dataset", key="tw_load_default_cases_btn"):
                     ds_id = ds_keys[ds_labels.index(ds_sel)]
-                    st.session_state["tw_cases_dataset"] = [standardize_tw_record_rule_mapping(x, st.session_state["tw_field_mapping"]) for x in DEFAULT_TW_CASESETS[ds_id]["cases"]]
+                    mapping = tw_field_mapping_frozen()
+                    lookup = _tw_key_lookup(mapping)
+                    st.session_state["tw_cases_dataset"] = [standardize_tw_record_rule_mapping(x, mapping, lookup) for x in DEFAULT_TW_CASESETS[ds_id]["cases"]]
                     st.session_state["tw_active_case_index"] = 0
                     # auto-apply first case to form
                     if st.session_state["tw_cases_dataset"]:
@@ -2173,7 +2879,7 @@ def render_tw_premarket_tab():
             if up is not None and st.button("Import + Standardize (rule mapping)", key="tw_import_cases_btn"):
                 try:
                     records = parse_uploaded_cases_file(up)
-                    ok, failures = standardize_tw_dataset_records(records, st.session_state["tw_field_mapping"])
+                    ok, failures = standardize_tw_dataset_records(records, tw_field_mapping_frozen())
                     st.session_state["tw_cases_dataset"] = ok
                     st.session_state["tw_active_case_index"] = 0
                     st.session_state["tw_cases_failures"] = failures
@@ -2215,7 +2921,7 @@ def render_tw_premarket_tab():
             if st.button("Update active case ← form", key="tw_update_active_case_btn"):
                 idx = st.session_state["tw_active_case_index"]
                 cur = build_tw_app_dict_from_session()
-                cur_std = standardize_tw_record_rule_mapping(cur, st.session_state["tw_field_mapping"])
+                cur_std = standardize_tw_record_rule_mapping(cur, tw_field_mapping_frozen())
                 cases[idx] = cur_std
                 st.session_state["tw_cases_dataset"] = cases
                 st.success("Updated active case in dataset from current form fields.")
@@ -2228,7 +2934,7 @@ def render_tw_premarket_tab():
 
         with st.expander("Edit cases dataset (table)", expanded=False):
             df = pd.DataFrame(cases).copy()
-            df = df[TW_APP_FIELDS] if all(c in df.columns for c in TW_APP_FIELDS) else df
+            df = df[TW_APP_FIELDS] if _TW_APP_FIELDS_SET.issubset(df.columns) else df
             edited_df = st.data_editor(df, use_container_width=True, num_rows="dynamic", key="tw_cases_data_editor")
             if st.button("Apply table edits to dataset", key="tw_apply_cases_table_btn"):
                 st.session_state["tw_cases_dataset"] = edited_df.fillna("").to_dict(orient="records")
@@ -2245,7 +2951,7 @@ def render_tw_premarket_tab():
                     if not isinstance(obj, list):
                         raise ValueError("JSON must be an object or a list of objects.")
                     # Standardize each row using rule mapping; skip failed rows
-                    ok, failures2 = standardize_tw_dataset_records([x for x in obj if isinstance(x, dict)], st.session_state["tw_field_mapping"])
+                    ok, failures2 = standardize_tw_dataset_records([x for x in obj if isinstance(x, dict)], tw_field_mapping_frozen())
                     st.session_state["tw_cases_dataset"] = ok
                     st.session_state["tw_cases_failures"] = failures2
                     if ok:
@@ -2465,7 +3171,11 @@ def render_tw_premarket_tab():
             st.success("Refreshed completeness + missing items.")
             st.rerun()
 
-    completeness = float(st.session_state.get("tw_completeness_last", compute_tw_app_completeness()))
+    # Only scan when nothing has been computed yet (a .get default would run the scan on every rerun).
+    completeness = st.session_state.get("tw_completeness_last")
+    if completeness is None:
+        completeness = compute_tw_app_completeness()
+    completeness = float(completeness)
     pct = int(completeness * 100)
     if pct >= 80:
         card_grad = "linear-gradient(135deg,#22c55e,#16a34a)"
@@ -3146,7 +3856,7 @@ Do not invent facts; reorganize and clarify only.
                     api_keys=api_keys,
                 )
                 st.session_state["subm_struct_md"] = out
-                log_event("510(k) Review Pipeline", "Submission Structurer", st.session_state.settings["model"], est_tokens(raw_subm + out))
+                log_event("510(k) Review Pipeline", "Submission Structurer", st.session_state.settings["model"], est_tokens(raw_subm + out, st.session_state.settings["model"]))
             except Exception as e:
                 st.error(f"Error: {e}")
 
@@ -3194,7 +3904,7 @@ Keep it grounded in evidence. If evidence is missing, say so explicitly.
                     api_keys=api_keys,
                 )
                 st.session_state["rep_md"] = out
-                log_event("510(k) Review Pipeline", "Review Memo Builder", st.session_state.settings["model"], est_tokens(user_prompt + out))
+                log_event("510(k) Review Pipeline", "Review Memo Builder", st.session_state.settings["model"], est_tokens(user_prompt + out, st.session_state.settings["model"]))
             except Exception as e:
                 st.error(f"Error: {e}")
 
@@ -3220,18 +3930,25 @@ def read_uploaded_note_file() -> str:
     return file.read().decode("utf-8", errors="ignore")
 
 
-def highlight_keywords_html(text: str, keywords: List[str], color: str = "#FF7F50") -> str:
-    if not text.strip() or not keywords:
-        return text
-    kws = sorted({k.strip() for k in keywords if k and k.strip()}, key=len, reverse=True)
-    out = text
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _keyword_regex(kws: Tuple[str, ...]) -> "re.Pattern[str]":
+    # One alternation, longest keyword first, so a single scan picks the longest match at each position.
+    alts = []
     for kw in kws:
         if re.search(r"[A-Za-z0-9]", kw):
-            pattern = re.compile(rf"(?<![\w-]){re.escape(kw)}(?![\w-])")
-            out = pattern.sub(rf'<span style="color:{color};font-weight:800;">{kw}</span>', out)
+            alts.append(rf"(?<![\w-]){re.escape(kw)}(?![\w-])")
         else:
-            out = out.replace(kw, f'<span style="color:{color};font-weight:800;">{kw}</span>')
-    return out
+            alts.append(re.escape(kw))
+    return re.compile("|".join(alts))
+
+
+def highlight_keywords_html(text: str, keywords: List[str], color: str = "#FF7F50") -> str:
+    if not text.strip() or not keywords:
+        return text
+    kws = tuple(sorted({k.strip() for k in keywords if k and k.strip()}, key=len, reverse=True))
+    if not kws:
+        return text
+    return _keyword_regex(kws).sub(lambda m: f'<span style="color:{color};font-weight:800;">{m.group(0)}</span>', text)
 
 
 def magic_ai_keywords(base_md: str, color: str, model: str) -> Tuple[List[str], str]:
@@ -3316,7 +4033,7 @@ Hard rules:
                 with st.spinner("Organizing note..."):
                     out = call_llm(model=note_model, system_prompt=system_prompt, user_prompt=user_prompt, max_tokens=int(note_max_tokens), temperature=0.15, api_keys=api_keys)
                 st.session_state["note_md"] = out
-                log_event("Note Keeper", "Note Organizer", note_model, est_tokens(user_prompt + out))
+                log_event("Note Keeper", "Note Organizer", note_model, est_tokens(user_prompt + out, note_model))
             except Exception as e:
                 st.error(f"Error: {e}")
 
@@ -3350,7 +4067,7 @@ Hard rules:
                     kws, highlighted = magic_ai_keywords(base_note, kw_color2, kw_model)
                     st.session_state["kw_ai_list"] = kws
                     st.session_state["kw_highlighted"] = highlighted
-                    log_event("Note Keeper", "AI Keywords", kw_model, est_tokens(base_note))
+                    log_event("Note Keeper", "AI Keywords", kw_model, est_tokens(base_note, kw_model))
                 except Exception as e:
                     st.error(f"AI Keywords failed: {e}")
     with cK5:
@@ -3381,7 +4098,7 @@ Hard rules:
                     api_keys=st.session_state.get("api_keys", {}),
                 )
                 st.session_state[f"{key_prefix}_out"] = out
-                log_event("Note Keeper", title, m, est_tokens(base_note + out))
+                log_event("Note Keeper", title, m, est_tokens(base_note + out, m))
             except Exception as e:
                 st.error(f"{title} failed: {e}")
         if st.session_state.get(f"{key_prefix}_out"):
@@ -3479,7 +4196,7 @@ def render_agents_config_tab():
     with c1:
         if st.button("Apply edited YAML to session", key="apply_edited_yaml"):
             try:
-                cfg = yaml.safe_load(edited_yaml_text) or {}
+                cfg = yaml.load(edited_yaml_text, Loader=_YAML_LOADER) or {}
                 if not isinstance(cfg, dict) or "agents" not in cfg:
                     st.error("Parsed YAML missing top-level key 'agents'. No changes applied.")
                 else:
@@ -3493,7 +4210,7 @@ def render_agents_config_tab():
         uploaded_agents_tab = st.file_uploader("Upload agents.yaml file", type=["yaml", "yml"], key="agents_yaml_tab_uploader")
         if uploaded_agents_tab is not None:
             try:
-                cfg = yaml.safe_load(uploaded_agents_tab.read()) or {}
+                cfg = yaml.load(uploaded_agents_tab.read(), Loader=_YAML_LOADER) or {}
                 if "agents" in cfg:
                     st.session_state["agents_cfg"] = ensure_fallback_agents(cfg)
                     st.success("Uploaded agents.yaml applied to this session.")
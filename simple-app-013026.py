@@ -1,44 +1,33 @@
 import os
 import json
+import functools
+import hashlib
+import importlib.util
 import base64
+import copy
 import random
 import re
+import string
 import difflib
-from datetime import datetime, date
-from io import BytesIO
-from typing import Dict, Any, List, Tuple, Optional
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from io import BytesIO, StringIO
+from types import MappingProxyType
+from typing import Dict, Any, Iterator, List, Tuple, Optional
 
 import streamlit as st
 import yaml
 import pandas as pd
-import altair as alt
-from pypdf import PdfReader
 
 try:
-    from docx import Document  # python-docx
+    import orjson  # optional, recommended: much faster JSON parsing than stdlib json
 except ImportError:
-    Document = None
+    orjson = None
 
-try:
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.pagesizes import letter
-except ImportError:
-    canvas = None
-    letter = None
-
-try:
-    import pytesseract
-    from pdf2image import convert_from_bytes
-    from PIL import Image
-except ImportError:
-    pytesseract = None
-    convert_from_bytes = None
-    Image = None
-
-from openai import OpenAI
-import google.generativeai as genai
-from anthropic import Anthropic
-import httpx
+# Heavy SDKs (LLM providers, pypdf, OCR) are imported on first use; see _openai_sdk() & co.
+HAS_OCR = all(importlib.util.find_spec(m) is not None for m in ("pytesseract", "pdf2image"))
 
 
 # ============================================================
@@ -70,38 +59,42 @@ ALL_MODELS = [
     "grok-4-fast-reasoning",
     "grok-4-1-fast-non-reasoning",
 ]
+ALL_MODELS_INDEX: Dict[str, int] = {m: i for i, m in enumerate(ALL_MODELS)}
 
-OPENAI_MODELS = {"gpt-4o-mini", "gpt-4.1-mini"}
-GEMINI_MODELS = {
+OPENAI_MODELS = frozenset({"gpt-4o-mini", "gpt-4.1-mini"})
+GEMINI_MODELS = frozenset({
     "gemini-2.5-flash",
     "gemini-3-flash-preview",
     "gemini-2.5-flash-lite",
     "gemini-3-pro-preview",
-}
-ANTHROPIC_MODELS = {
+})
+ANTHROPIC_MODELS = frozenset({
     "claude-3-5-sonnet-20241022",
     "claude-3-5-haiku-20241022",
     "claude-3-opus-20240229",
-}
-GROK_MODELS = {"grok-4-fast-reasoning", "grok-4-1-fast-non-reasoning"}
+})
+GROK_MODELS = frozenset({"grok-4-fast-reasoning", "grok-4-1-fast-non-reasoning"})
+
+
+MODEL_TO_PROVIDER: Mapping[str, str] = MappingProxyType({
+    **{m: "openai" for m in OPENAI_MODELS},
+    **{m: "gemini" for m in GEMINI_MODELS},
+    **{m: "anthropic" for m in ANTHROPIC_MODELS},
+    **{m: "grok" for m in GROK_MODELS},
+})
 
 
 def get_provider(model: str) -> str:
-    if model in OPENAI_MODELS:
-        return "openai"
-    if model in GEMINI_MODELS:
-        return "gemini"
-    if model in ANTHROPIC_MODELS:
-        return "anthropic"
-    if model in GROK_MODELS:
-        return "grok"
-    raise ValueError(f"Unknown/unsupported model: {model}")
+    provider = MODEL_TO_PROVIDER.get(model)
+    if provider is None:
+        raise ValueError(f"Unknown/unsupported model: {model}")
+    return provider
 
 
 # ============================================================
 # 2) i18n (English / zh-TW)
 # ============================================================
-I18N: Dict[str, Dict[str, str]] = {
+_I18N_RAW: Dict[str, Dict[str, str]] = {
     "en": {
         "app_title": "Antigravity AI Workspace",
         "top_tagline": "A WOW workspace for agents, dashboards, notes, and art styles",
@@ -119,14 +112,26 @@ I18N: Dict[str, Dict[str, str]] = {
         "reload_defaults": "重新載入預設資料集",
     },
 }
+# Read-only view shared by every rerun/session; t() lookups never mutate it.
+I18N: Mapping[str, Mapping[str, str]] = MappingProxyType({lang: MappingProxyType(table) for lang, table in _I18N_RAW.items()})
 
 
 def lang_code() -> str:
     return st.session_state.settings.get("language", "zh-tw")
 
 
+# Active-language table, resolved once per rerun by set_active_language() so t() is a single dict lookup.
+_ACTIVE_I18N: Mapping[str, str] = I18N["en"]
+
+
+def set_active_language(lang: str):
+    global _ACTIVE_I18N
+    st.session_state.settings["language"] = lang
+    _ACTIVE_I18N = I18N.get(lang, I18N["en"])
+
+
 def t(key: str) -> str:
-    return I18N.get(lang_code(), I18N["en"]).get(key, key)
+    return _ACTIVE_I18N.get(key, key)
 
 
 # ============================================================
@@ -136,6 +141,7 @@ PAINTER_STYLES_20 = [
     "Van Gogh", "Picasso", "Monet", "Da Vinci", "Dali", "Mondrian", "Warhol", "Rembrandt", "Klimt", "Hokusai",
     "Munch", "O'Keeffe", "Basquiat", "Matisse", "Pollock", "Kahlo", "Hopper", "Magritte", "Cyberpunk", "Bauhaus",
 ]
+PAINTER_STYLES_INDEX: Dict[str, int] = {s: i for i, s in enumerate(PAINTER_STYLES_20)}
 
 STYLE_TOKENS: Dict[str, Dict[str, str]] = {
     "Van Gogh": {"--bg1": "#0b1020", "--bg2": "#1f3b73", "--accent": "#f7c948", "--accent2": "#60a5fa", "--card": "rgba(255,255,255,0.10)", "--border": "rgba(255,255,255,0.22)"},
@@ -143,117 +149,164 @@ STYLE_TOKENS: Dict[str, Dict[str, str]] = {
     "Cyberpunk": {"--bg1": "#050816", "--bg2": "#1b0033", "--accent": "#22d3ee", "--accent2": "#a78bfa", "--card": "rgba(255,255,255,0.08)", "--border": "rgba(34,211,238,0.25)"},
 }
 
-def apply_style_engine(theme_mode: str, painter_style: str):
-    tokens = STYLE_TOKENS.get(painter_style, STYLE_TOKENS["Van Gogh"])
-    is_dark = theme_mode.lower() == "dark"
-    text_color = "#e5e7eb" if is_dark else "#0f172a"
-    subtext = "#cbd5e1" if is_dark else "#334155"
-    shadow = "0 18px 50px rgba(0,0,0,0.38)" if is_dark else "0 18px 50px rgba(2,6,23,0.18)"
-    glass = "rgba(17,24,39,0.38)" if is_dark else "rgba(255,255,255,0.55)"
-
-    css = f"""
+_STYLE_CSS_TEMPLATE = string.Template("""
     <style>
-    :root {{
-        {"".join([f"{k}:{v};" for k,v in tokens.items()])}
-        --text: {text_color};
-        --subtext: {subtext};
-        --glass: {glass};
-        --shadow: {shadow};
+    :root {
+        $tokens
+        --text: $text_color;
+        --subtext: $subtext;
+        --glass: $glass;
+        --shadow: $shadow;
         --radius: 18px;
         --radius2: 26px;
         --coral: #FF7F50;
-    }}
-    body {{
+    }
+    body {
         color: var(--text);
         background: radial-gradient(1200px circle at 12% 8%, var(--bg2) 0%, transparent 55%),
                     radial-gradient(900px circle at 88% 18%, var(--accent2) 0%, transparent 50%),
                     linear-gradient(135deg, var(--bg1), var(--bg2));
         background-attachment: fixed;
-    }}
-    .block-container {{ padding-top: 1.0rem; padding-bottom: 3.5rem; }}
-    .wow-hero {{
+    }
+    .block-container { padding-top: 1.0rem; padding-bottom: 3.5rem; }
+    .wow-hero {
         border-radius: var(--radius2); padding: 18px 18px; margin: 0 0 14px 0;
         background: linear-gradient(135deg, rgba(255,255,255,0.10), rgba(255,255,255,0.02));
         border: 1px solid var(--border); box-shadow: var(--shadow); backdrop-filter: blur(12px);
-    }}
-    .wow-title {{ font-size: 1.35rem; font-weight: 800; letter-spacing: 0.02em; margin: 0; color: var(--text); }}
-    .wow-subtitle {{ margin: 6px 0 0 0; color: var(--subtext); font-size: 0.95rem; }}
-    .wow-card {{
+    }
+    .wow-title { font-size: 1.35rem; font-weight: 800; letter-spacing: 0.02em; margin: 0; color: var(--text); }
+    .wow-subtitle { margin: 6px 0 0 0; color: var(--subtext); font-size: 0.95rem; }
+    .wow-card {
         border-radius: var(--radius); padding: 14px 16px; background: var(--glass);
         border: 1px solid var(--border); box-shadow: var(--shadow); backdrop-filter: blur(12px);
-    }}
-    .wow-kpi {{ font-size: 1.55rem; font-weight: 800; margin-top: 4px; }}
-    .wow-muted {{ color: var(--subtext); font-size: 0.92rem; }}
-    .stButton > button {{
+    }
+    .wow-kpi { font-size: 1.55rem; font-weight: 800; margin-top: 4px; }
+    .wow-muted { color: var(--subtext); font-size: 0.92rem; }
+    .stButton > button {
         border-radius: 999px !important; border: 1px solid var(--border) !important;
         background: linear-gradient(135deg, var(--accent), var(--accent2)) !important;
         color: #0b1020 !important; font-weight: 800 !important;
-    }}
-    .wow-badge {{
+    }
+    .wow-badge {
         display:inline-flex; align-items:center; padding: 3px 10px; border-radius: 999px;
         font-size: 0.78rem; font-weight: 700; border: 1px solid var(--border);
         background: rgba(255,255,255,0.10); color: var(--text);
-    }}
+    }
     </style>
-    """
-    st.markdown(css, unsafe_allow_html=True)
+    """)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _build_style_css(theme_mode: str, painter_style: str) -> str:
+    """The <style> blob for a (theme, painter style) pair; cached so reruns skip the template render."""
+    tokens = STYLE_TOKENS.get(painter_style, STYLE_TOKENS["Van Gogh"])
+    is_dark = theme_mode.lower() == "dark"
+    return _STYLE_CSS_TEMPLATE.substitute(
+        tokens="".join(f"{k}:{v};" for k, v in tokens.items()),
+        text_color="#e5e7eb" if is_dark else "#0f172a",
+        subtext="#cbd5e1" if is_dark else "#334155",
+        shadow="0 18px 50px rgba(0,0,0,0.38)" if is_dark else "0 18px 50px rgba(2,6,23,0.18)",
+        glass="rgba(17,24,39,0.38)" if is_dark else "rgba(255,255,255,0.55)",
+    )
+
+def apply_style_engine(theme_mode: str, painter_style: str):
+    st.markdown(_build_style_css(theme_mode, painter_style), unsafe_allow_html=True)
 
 
 # ============================================================
 # 4) Data Loading Logic (Datasets & Guidance)
 # ============================================================
-def load_default_datasets_from_file() -> Tuple[Dict[str, Any], Dict[str, Any]]:
-    """Loads defaultdataset.json containing tw_cases and k510_checklists."""
+DEFAULT_DATASET_PATH = "defaultdataset.json"
+DEFAULT_GUIDE_PATH = "defaultguide.md"
+
+# Regex to find sections: <!-- BEGIN_SECTION: id | TITLE: title --> ... <!-- END_SECTION -->
+# Runs over the raw file bytes; only ids/titles are decoded up front.
+_SECTION_RE = re.compile(
+    rb"<!--\s*BEGIN_SECTION:\s*(?P<id>[^|\n]*?)\s*\|\s*TITLE:\s*(?P<title>[^\n]*?)\s*-->(?P<body>.*?)<!--\s*END_SECTION\s*-->",
+    re.DOTALL
+)
+
+class LazyGuide(Mapping):
+    """Guidance sections keyed by id, backed by the raw file bytes.
+
+    Each value is {"title", "md"}; a section's body is decoded on first access.
+    """
+
+    def __init__(self, raw: bytes):
+        self._raw = raw
+        self._spans: Dict[str, Tuple[str, int, int]] = {}
+        self._entries: Dict[str, Dict[str, str]] = {}
+
+    def add(self, key: str, title: str, start: int, end: int):
+        self._spans[key] = (title, start, end)
+
+    def __getitem__(self, key: str) -> Dict[str, str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            title, start, end = self._spans[key]
+            entry = {"title": title, "md": self._raw[start:end].decode("utf-8").strip()}
+            self._entries[key] = entry
+        return entry
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+def _file_mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+@st.cache_resource(show_spinner=False)
+def load_default_datasets_from_file(path: str = DEFAULT_DATASET_PATH, mtime: float = 0.0) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Loads defaultdataset.json containing tw_cases and k510_checklists (shared across sessions per path + mtime; treat as read-only)."""
     tw_cases = {}
     k510_checklists = {}
     try:
-        with open("defaultdataset.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(path, "rb") as f:
+            raw = f.read()
+            data = orjson.loads(raw) if orjson else json.loads(raw)
             tw_cases = data.get("tw_cases", {})
             k510_checklists = data.get("k510_checklists", {})
     except FileNotFoundError:
-        st.error("Default dataset file 'defaultdataset.json' not found.")
+        st.error(f"Default dataset file '{path}' not found.")
     except Exception as e:
-        st.error(f"Error loading defaultdataset.json: {e}")
+        st.error(f"Error loading {path}: {e}")
     return tw_cases, k510_checklists
 
-def load_default_guidance_from_file() -> Tuple[Dict[str, Dict[str, str]], Dict[str, Dict[str, str]]]:
-    """Loads defaultguide.md and parses sections for TW and 510k guidances."""
-    tw_guides = {}
-    k510_guides = {}
+@st.cache_resource(show_spinner=False)
+def load_default_guidance_from_file(path: str = DEFAULT_GUIDE_PATH, mtime: float = 0.0) -> Tuple[Mapping, Mapping]:
+    """Loads defaultguide.md and parses sections for TW and 510k guidances (shared across sessions per path + mtime; treat as read-only)."""
+    tw_guides: Mapping = {}
+    k510_guides: Mapping = {}
     
     try:
-        with open("defaultguide.md", "r", encoding="utf-8") as f:
-            content = f.read()
+        with open(path, "rb") as f:
+            raw = f.read()
+        tw_guides, k510_guides = LazyGuide(raw), LazyGuide(raw)
         
-        # Regex to find sections: <!-- BEGIN_SECTION: id | TITLE: title --> ... <!-- END_SECTION -->
-        pattern = re.compile(
-            r"<!--\s*BEGIN_SECTION:\s*(.*?)\s*\|\s*TITLE:\s*(.*?)\s*-->(.*?)<!--\s*END_SECTION\s*-->", 
-            re.DOTALL
-        )
-        matches = pattern.findall(content)
-        
-        for key, title, body in matches:
-            key = key.strip()
-            title = title.strip()
-            body = body.strip()
-            entry = {"title": title, "md": body}
+        for m in _SECTION_RE.finditer(raw):
+            key = m.group("id").decode("utf-8").strip()
+            title = m.group("title").decode("utf-8").strip()
+            start, end = m.span("body")
             
             if key.startswith("tw_"):
-                tw_guides[key] = entry
+                tw_guides.add(key, title, start, end)
             elif key.startswith("k510_"):
-                k510_guides[key] = entry
+                k510_guides.add(key, title, start, end)
                 
     except FileNotFoundError:
-        st.error("Default guidance file 'defaultguide.md' not found.")
+        st.error(f"Default guidance file '{path}' not found.")
     except Exception as e:
-        st.error(f"Error loading defaultguide.md: {e}")
+        st.error(f"Error loading {path}: {e}")
         
     return tw_guides, k510_guides
 
 def refresh_defaults():
-    tw_c, k510_c = load_default_datasets_from_file()
-    tw_g, k510_g = load_default_guidance_from_file()
+    tw_c, k510_c = load_default_datasets_from_file(DEFAULT_DATASET_PATH, _file_mtime(DEFAULT_DATASET_PATH))
+    tw_g, k510_g = load_default_guidance_from_file(DEFAULT_GUIDE_PATH, _file_mtime(DEFAULT_GUIDE_PATH))
     st.session_state["DEFAULT_TW_CASESETS"] = tw_c
     st.session_state["DEFAULT_510K_CHECKLIST_SETS"] = k510_c
     st.session_state["DEFAULT_TW_GUIDANCES"] = tw_g
@@ -270,6 +323,8 @@ if "settings" not in st.session_state:
         "model": "gpt-4o-mini", "max_tokens": 12000, "temperature": 0.2, "token_budget_est": 250_000,
     }
 
+set_active_language(lang_code())
+
 if "history" not in st.session_state:
     st.session_state["history"] = []
 
@@ -314,6 +369,8 @@ TW_APP_FIELDS = [
     "preclinical_info", "preclinical_replace", "clinical_just", "clinical_info",
 ]
 BOOL_FIELDS = {"confirm_match", "cert_raps", "cert_ahwp"}
+TW_APP_FIELDS_SET = frozenset(TW_APP_FIELDS)
+_TW_DEFAULTS: Dict[str, Any] = {f: (False if f in BOOL_FIELDS else "") for f in TW_APP_FIELDS}
 
 
 # ============================================================
@@ -333,95 +390,242 @@ def api_status(provider: str) -> Tuple[str, str]:
     if st.session_state["api_keys"].get(provider, "").strip(): return "session", t("provided_session")
     return "missing", t("missing")
 
+@functools.lru_cache(maxsize=None)
+def _openai_sdk():
+    import openai
+    return openai
+
+@functools.lru_cache(maxsize=None)
+def _anthropic_sdk():
+    import anthropic
+    return anthropic
+
+@functools.lru_cache(maxsize=None)
+def _genai_sdk():
+    import google.generativeai as genai
+    return genai
+
+@functools.lru_cache(maxsize=None)
+def _httpx_sdk():
+    import httpx
+    return httpx
+
+# Clients are process-wide (shared by every session) and keyed on a digest of the API key,
+# so the raw key is never part of a cache key; the leading "_" keeps Streamlit from hashing it.
+HTTP_POOL_LIMITS = {"max_keepalive_connections": 32, "max_connections": 64}
+
+def _key_id(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+@st.cache_resource(show_spinner=False)
+def _openai_client(key_id: str, _key: str):
+    openai = _openai_sdk()
+    return openai.OpenAI(api_key=_key, http_client=openai.DefaultHttpxClient(limits=_httpx_sdk().Limits(**HTTP_POOL_LIMITS)))
+
+@st.cache_resource(show_spinner=False)
+def _anthropic_client(key_id: str, _key: str):
+    anthropic = _anthropic_sdk()
+    return anthropic.Anthropic(api_key=_key, http_client=anthropic.DefaultHttpxClient(limits=_httpx_sdk().Limits(**HTTP_POOL_LIMITS)))
+
+@st.cache_resource(show_spinner=False)
+def _gemini_model(key_id: str, model: str, _key: str):
+    genai = _genai_sdk()
+    genai.configure(api_key=_key)
+    return genai.GenerativeModel(model)
+
+@st.cache_resource(show_spinner=False)
+def _grok_client(key_id: str, _key: str):
+    httpx = _httpx_sdk()
+    return httpx.Client(base_url="https://api.x.ai/v1", timeout=90, headers={"Authorization": f"Bearer {_key}"}, limits=httpx.Limits(**HTTP_POOL_LIMITS))
+
 def call_llm(model: str, system_prompt: str, user_prompt: str, max_tokens: int = 12000, temperature: float = 0.2, api_keys: Optional[dict] = None) -> str:
     provider = get_provider(model)
     key = get_api_key(provider, api_keys or {})
     if not key: raise RuntimeError(f"Missing API key for provider: {provider}")
 
     if provider == "openai":
-        client = OpenAI(api_key=key)
-        resp = client.chat.completions.create(model=model, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}], max_tokens=max_tokens, temperature=temperature)
+        resp = _openai_client(_key_id(key), key).chat.completions.create(model=model, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}], max_tokens=max_tokens, temperature=temperature)
         return resp.choices[0].message.content
     if provider == "gemini":
-        genai.configure(api_key=key)
-        llm = genai.GenerativeModel(model)
-        resp = llm.generate_content(system_prompt + "\n\n" + user_prompt, generation_config={"max_output_tokens": max_tokens, "temperature": temperature})
+        _genai_sdk().configure(api_key=key)  # genai keeps the key in global config; re-point it before each call
+        resp = _gemini_model(_key_id(key), model, key).generate_content(system_prompt + "\n\n" + user_prompt, generation_config={"max_output_tokens": max_tokens, "temperature": temperature})
         return resp.text
     if provider == "anthropic":
-        client = Anthropic(api_key=key)
-        resp = client.messages.create(model=model, system=system_prompt, max_tokens=max_tokens, temperature=temperature, messages=[{"role": "user", "content": user_prompt}])
+        resp = _anthropic_client(_key_id(key), key).messages.create(model=model, system=system_prompt, max_tokens=max_tokens, temperature=temperature, messages=[{"role": "user", "content": user_prompt}])
         return resp.content[0].text
     if provider == "grok":
-        with httpx.Client(base_url="https://api.x.ai/v1", timeout=90) as client:
-            resp = client.post("/chat/completions", headers={"Authorization": f"Bearer {key}"}, json={"model": model, "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}], "max_tokens": max_tokens, "temperature": temperature})
-            return resp.json()["choices"][0]["message"]["content"]
+        resp = _grok_client(_key_id(key), key).post("/chat/completions", json={"model": model, "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}], "max_tokens": max_tokens, "temperature": temperature})
+        data = orjson.loads(resp.content) if orjson else resp.json()
+        return data["choices"][0]["message"]["content"]
     raise RuntimeError(f"Unsupported provider")
 
+def _json_digest(obj: Any) -> str:
+    """Short content digest of a JSON-able value; callers store it next to the value and refresh it on write."""
+    return hashlib.blake2b(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"), digest_size=8).hexdigest()
+
+def llm_request_digest(model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float, api_keys: Optional[dict] = None) -> str:
+    """Stable digest of one LLM request, scoped to the API key that would serve it."""
+    key = get_api_key(get_provider(model), api_keys or {})
+    h = hashlib.blake2b(digest_size=16)
+    for part in (model, system_prompt, user_prompt, str(int(max_tokens)), repr(float(temperature)), _key_id(key) if key else ""):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def _stream_provider(provider: str, key: str, model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float) -> Iterator[str]:
+    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+    if provider == "openai":
+        stream = _openai_client(_key_id(key), key).chat.completions.create(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True)
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content: yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+        return
+    if provider == "gemini":
+        _genai_sdk().configure(api_key=key)
+        for chunk in _gemini_model(_key_id(key), model, key).generate_content(system_prompt + "\n\n" + user_prompt, generation_config={"max_output_tokens": max_tokens, "temperature": temperature}, stream=True):
+            if chunk.parts: yield chunk.text
+        return
+    if provider == "anthropic":
+        with _anthropic_client(_key_id(key), key).messages.stream(model=model, system=system_prompt, max_tokens=max_tokens, temperature=temperature, messages=[{"role": "user", "content": user_prompt}]) as s:
+            yield from s.text_stream
+        return
+    if provider == "grok":
+        with _grok_client(_key_id(key), key).stream("POST", "/chat/completions", json={"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": temperature, "stream": True}) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if not line.startswith("data: "): continue
+                payload = line[6:]
+                if payload.strip() == "[DONE]": break
+                data = orjson.loads(payload) if orjson else json.loads(payload)
+                delta = (data.get("choices") or [{}])[0].get("delta", {}).get("content")
+                if delta: yield delta
+        return
+    raise RuntimeError(f"Unsupported provider")
+
+def stream_llm(model: str, system_prompt: str, user_prompt: str, max_tokens: int = 12000, temperature: float = 0.2, api_keys: Optional[dict] = None, max_chars: Optional[int] = None) -> Iterator[str]:
+    """Streaming counterpart of call_llm for st.write_stream; stops early once `max_chars` have been yielded."""
+    provider = get_provider(model)
+    key = get_api_key(provider, api_keys or {})
+    if not key: raise RuntimeError(f"Missing API key for provider: {provider}")
+    total = 0
+    for piece in _stream_provider(provider, key, model, system_prompt, user_prompt, max_tokens, temperature):
+        yield piece
+        total += len(piece)
+        if max_chars is not None and total >= max_chars: return  # closing the generator closes the provider stream
+
 
 # ============================================================
 # 7) Utilities (PDF, Markdown, etc)
 # ============================================================
-def est_tokens(text: str) -> int: return max(1, int(len(text or "") / 4))
+def est_tokens(text: str) -> int: return (len(text) >> 2) or 1
 def log_event(tab: str, agent: str, model: str, tokens_est: int, meta: Optional[dict] = None):
-    st.session_state["history"].append({"tab": tab, "agent": agent, "model": model, "tokens_est": int(tokens_est), "ts": datetime.utcnow().isoformat(), "meta": meta or {}})
+    st.session_state["history"].append({"tab": tab, "agent": agent, "model": model, "tokens_est": int(tokens_est), "ts": time.time(), "meta": meta or {}})
 
-def extract_pdf_pages_to_text(file, start_page: int, end_page: int, use_ocr: bool = False) -> str:
-    pdf_text = ""
+def _ocr_image(img) -> str:
+    import pytesseract
+    return pytesseract.image_to_string(img, lang="eng+chi_tra")
+
+def iter_pdf_text(raw: bytes, start_page: int, end_page: int, max_chars: Optional[int] = None) -> Iterator[str]:
+    """Yields the text layer page by page, stopping once `max_chars` characters have been produced."""
+    from pypdf import PdfReader
+    reader = PdfReader(BytesIO(raw))
+    total = 0
+    for i in range(max(0, start_page - 1), min(len(reader.pages), end_page)):
+        text = reader.pages[i].extract_text()
+        if not text: continue
+        yield text
+        total += len(text)
+        if max_chars is not None and total >= max_chars: return
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _pypdf_pages_to_text(raw: bytes, start_page: int, end_page: int, max_chars: Optional[int] = None) -> str:
+    buf = StringIO()
     try:
-        reader = PdfReader(file)
-        n = len(reader.pages)
-        raw_texts = []
-        for i in range(max(0, start_page - 1), min(n, end_page)):
-            raw_texts.append(reader.pages[i].extract_text() or "")
-        pdf_text = "\n\n".join(raw_texts).strip()
-    except Exception as e: print(f"pypdf extraction error: {e}")
-    if use_ocr and pytesseract and convert_from_bytes:
+        for text in iter_pdf_text(raw, start_page, end_page, max_chars):
+            buf.write(text)
+            buf.write("\n\n")
+    except Exception as e:
+        print(f"pypdf extraction error: {e}")
+    return buf.getvalue().strip()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _ocr_pages_to_text(raw: bytes, start_page: int, end_page: int) -> str:
+    from pdf2image import convert_from_bytes
+    images = convert_from_bytes(raw, first_page=start_page, last_page=end_page, thread_count=4, fmt="jpeg")
+    # Tesseract runs out-of-process and releases the GIL, so pages OCR in parallel threads.
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(images)))) as ex:
+        ocr_text = list(ex.map(_ocr_image, images))
+    return "\n\n".join(ocr_text).strip()
+
+def extract_pdf_pages_to_text(file, start_page: int, end_page: int, use_ocr: bool = False, max_chars: Optional[int] = None) -> str:
+    # Read the upload once; both extractors work from the same bytes (and cache on them).
+    raw = file.getvalue() if hasattr(file, "getvalue") else file.read()
+    # OCR output replaces the text layer entirely, so pypdf only runs when OCR is off or fails.
+    if use_ocr and HAS_OCR:
         try:
-            file.seek(0)
-            images = convert_from_bytes(file.read(), first_page=start_page, last_page=end_page)
-            ocr_text = [pytesseract.image_to_string(img, lang="eng+chi_tra") for img in images]
-            return "\n\n".join(ocr_text).strip()
-        except Exception as e: return pdf_text + f"\n\n[OCR failed: {e}]"
-    return pdf_text
+            return _ocr_pages_to_text(raw, start_page, end_page)
+        except Exception as e:
+            return _pypdf_pages_to_text(raw, start_page, end_page, max_chars) + f"\n\n[OCR failed: {e}]"
+    return _pypdf_pages_to_text(raw, start_page, end_page, max_chars)
 
 def status_row(label: str, status: str):
     color = {"pending": "dot-amber", "running": "dot-amber", "done": "dot-green", "error": "dot-red", "idle": "dot-amber", "thinking": "dot-amber"}.get(status, "dot-amber")
     st.markdown(f'<div style="display:flex; align-items:center; gap:10px; margin:2px 0;"><span class="dot {color}"></span><div style="font-weight:800;">{label}</div><span class="wow-badge">{status}</span></div>', unsafe_allow_html=True)
 
-def normalize_md(md: str) -> str: return re.sub(r"\n{3,}", "\n\n", (md or "").strip())
+_MULTI_NL_RE = re.compile(r"\n{3,}")
+
+def normalize_md(md: str) -> str: return _MULTI_NL_RE.sub("\n\n", (md or "").strip())
+
+DIFF_LARGE_LINES = 5000  # above this many lines, shrink diff context to 1 line
 
 def diff_markdown(a: str, b: str) -> str:
-    diff = difflib.unified_diff((a or "").splitlines(keepends=True), (b or "").splitlines(keepends=True), fromfile="A.md", tofile="B.md")
-    return "".join(diff).strip()
+    a_lines = (a or "").splitlines(keepends=True)
+    b_lines = (b or "").splitlines(keepends=True)
+    n = 1 if max(len(a_lines), len(b_lines)) > DIFF_LARGE_LINES else 3
+    return "".join(difflib.unified_diff(a_lines, b_lines, fromfile="A.md", tofile="B.md", n=n)).strip()
 
 def merge_guidance_markdowns(mds: List[str], extra_rules_md: str = "") -> str:
-    parts = [normalize_md(x) for x in (mds or []) if normalize_md(x)]
-    if extra_rules_md.strip(): parts.append("## 自訂追加規則\n" + normalize_md(extra_rules_md))
-    return normalize_md("\n\n---\n\n".join(parts))
+    # Each part is normalized exactly once; joining stripped parts with the separator
+    # cannot produce 3+ newlines, so the merged result needs no second pass.
+    parts = [p for p in (normalize_md(x) for x in (mds or [])) if p]
+    extra = normalize_md(extra_rules_md)
+    if extra: parts.append("## 自訂追加規則\n" + extra)
+    return "\n\n---\n\n".join(parts)
+
+_TRUTHY = frozenset({"true", "1", "yes", "y", "是", "有", "checked"})
 
 def _to_bool(v: Any) -> bool:
-    if isinstance(v, bool): return v
-    s = str(v).strip().lower()
-    return s in {"true", "1", "yes", "y", "是", "有", "checked"}
+    if v is True or v is False: return v
+    if v is None or v == "": return False
+    return str(v).strip().lower() in _TRUTHY
 
 def standardize_tw_record_rule_mapping(raw: Dict[str, Any], mapping: Dict[str, str]) -> Dict[str, Any]:
-    out: Dict[str, Any] = {}
+    out: Dict[str, Any] = _TW_DEFAULTS.copy()
     for k, v in (raw or {}).items():
-        if k in TW_APP_FIELDS: out[k] = v
+        if k in TW_APP_FIELDS_SET: out[k] = v
         elif k in mapping: out[mapping[k]] = v
-        elif str(k).strip() in mapping: out[mapping[str(k).strip()]] = v
-    for f in TW_APP_FIELDS:
-        if f not in out: out[f] = False if f in BOOL_FIELDS else ""
-    for bf in BOOL_FIELDS: out[bf] = _to_bool(out.get(bf, False))
+        else:
+            ks = (k if isinstance(k, str) else str(k)).strip()
+            if ks in mapping: out[mapping[ks]] = v
+    for bf in BOOL_FIELDS: out[bf] = _to_bool(out[bf])
     return out
 
 
 # ============================================================
 # 8) Agents YAML
 # ============================================================
+try:
+    _YAML_LOADER = yaml.CSafeLoader  # libyaml C loader, ~10x faster than pure-Python SafeLoader
+except AttributeError:
+    _YAML_LOADER = yaml.SafeLoader
+
+@st.cache_resource(show_spinner=False)
 def load_agents_cfg() -> Dict[str, Any]:
+    """Parsed agents.yaml, shared across sessions. Callers must copy before mutating."""
     try:
-        with open("agents.yaml", "r", encoding="utf-8") as f: return yaml.safe_load(f) or {"agents": {}}
+        with open("agents.yaml", "r", encoding="utf-8") as f: return yaml.load(f, Loader=_YAML_LOADER) or {"agents": {}}
     except Exception: return {"agents": {}}
 
 def ensure_fallback_agents(cfg: Dict[str, Any]) -> Dict[str, Any]:
@@ -440,7 +644,9 @@ def ensure_fallback_agents(cfg: Dict[str, Any]) -> Dict[str, Any]:
     put("translator", {"name": "Translator", "model": "gemini-2.5-flash", "system_prompt": "You translate accurately."})
     return cfg
 
-if "agents_cfg" not in st.session_state: st.session_state["agents_cfg"] = ensure_fallback_agents(load_agents_cfg())
+if "agents_cfg" not in st.session_state:
+    st.session_state["agents_cfg"] = ensure_fallback_agents(copy.deepcopy(load_agents_cfg()))
+    st.session_state["agents_cfg_hash"] = _json_digest(st.session_state["agents_cfg"])
 
 def agent_run_ui(agent_id, tab_key, default_prompt, default_input_text="", allow_model_override=True, tab_label_for_history=None):
     agent_cfg = st.session_state["agents_cfg"].get("agents", {}).get(agent_id, {})
@@ -450,17 +656,25 @@ def agent_run_ui(agent_id, tab_key, default_prompt, default_input_text="", allow
     st.markdown(f"**Agent:** {name}")
     c1, c2, c3 = st.columns([2.2, 1.0, 1.0])
     with c1: prompt = st.text_area("System/User Prompt", value=st.session_state.get(f"{tab_key}_prompt", default_prompt), height=100, key=f"{tab_key}_prompt")
-    with c2: model = st.selectbox("Model", ALL_MODELS, index=ALL_MODELS.index(base_model) if base_model in ALL_MODELS else 0, key=f"{tab_key}_model")
+    with c2: model = st.selectbox("Model", ALL_MODELS, index=ALL_MODELS_INDEX.get(base_model, 0), key=f"{tab_key}_model")
     with c3: max_tokens = st.number_input("Max Tokens", 1000, 100000, 12000, key=f"{tab_key}_max_tokens")
     
     inp = st.text_area("Input Text", value=st.session_state.get(f"{tab_key}_input", default_input_text), height=150, key=f"{tab_key}_input")
     
     if st.button(f"Run {name}", key=f"{tab_key}_run"):
-        with st.spinner("Thinking..."):
+        system_prompt = agent_cfg.get("system_prompt", "")
+        user_prompt = prompt + "\n\n" + inp
+        digest = llm_request_digest(model, system_prompt, user_prompt, max_tokens, 0.2, st.session_state.get("api_keys"))
+        if digest == st.session_state.get(f"{tab_key}_digest") and st.session_state.get(f"{tab_key}_output"):
+            st.info("Inputs unchanged since the last run; reusing its output.")
+        else:
             try:
-                out = call_llm(model, agent_cfg.get("system_prompt", ""), prompt + "\n\n" + inp, max_tokens, 0.2, st.session_state.get("api_keys"))
+                # Client-side cap mirrors max_tokens with the same ~4 chars/token estimate as est_tokens.
+                out = st.write_stream(stream_llm(model, system_prompt, user_prompt, max_tokens, 0.2, st.session_state.get("api_keys"), max_chars=int(max_tokens) * 4))
+                out = out if isinstance(out, str) else "".join(map(str, out or []))
                 st.session_state[f"{tab_key}_output"] = out
-                log_event(tab_label_for_history or tab_key, name, model, est_tokens(inp+out))
+                st.session_state[f"{tab_key}_digest"] = digest
+                log_event(tab_label_for_history or tab_key, name, model, est_tokens(inp + out))
             except Exception as e: st.error(f"Error: {e}")
             
     if st.session_state.get(f"{tab_key}_output"):
@@ -470,29 +684,69 @@ def agent_run_ui(agent_id, tab_key, default_prompt, default_input_text="", allow
 # ============================================================
 # 9) UI Sections
 # ============================================================
+@st.cache_data(max_entries=8, show_spinner=False)
+def _sidebar_static_options(lang: str) -> Dict[str, Any]:
+    """Translated sidebar labels/option lists for one language (no widgets, safe to cache)."""
+    tr = I18N.get(lang, I18N["en"])
+    label = lambda k: tr.get(k, k)
+    return {
+        "global_settings": label("global_settings"),
+        "reload_defaults": label("reload_defaults"),
+        "theme": label("theme"),
+        "theme_options": [label("light"), label("dark")],
+        "painter_style": label("painter_style"),
+        "default_model": label("default_model"),
+        "api_keys": label("api_keys"),
+    }
+
 def render_sidebar():
+    opts = _sidebar_static_options(lang_code())
     with st.sidebar:
-        st.markdown(f"## {t('global_settings')}")
-        if st.button(t("reload_defaults")):
+        st.markdown(f"## {opts['global_settings']}")
+        if st.button(opts["reload_defaults"]):
+            load_default_datasets_from_file.clear()
+            load_default_guidance_from_file.clear()
             refresh_defaults()
             st.rerun()
             
-        theme_choice = st.radio(t("theme"), [t("light"), t("dark")], index=0 if st.session_state.settings["theme"] == "Light" else 1, horizontal=True)
-        st.session_state.settings["theme"] = "Light" if theme_choice == t("light") else "Dark"
+        theme_choice = st.radio(opts["theme"], opts["theme_options"], index=0 if st.session_state.settings["theme"] == "Light" else 1, horizontal=True)
+        st.session_state.settings["theme"] = "Light" if theme_choice == opts["theme_options"][0] else "Dark"
         
-        style = st.selectbox(t("painter_style"), PAINTER_STYLES_20, index=PAINTER_STYLES_20.index(st.session_state.settings["painter_style"]))
+        style = st.selectbox(opts["painter_style"], PAINTER_STYLES_20, index=PAINTER_STYLES_INDEX.get(st.session_state.settings["painter_style"], 0))
         st.session_state.settings["painter_style"] = style
         
-        st.session_state.settings["model"] = st.selectbox(t("default_model"), ALL_MODELS, index=ALL_MODELS.index(st.session_state.settings["model"]))
+        st.session_state.settings["model"] = st.selectbox(opts["default_model"], ALL_MODELS, index=ALL_MODELS_INDEX.get(st.session_state.settings["model"], 0))
         
         st.markdown("---")
-        st.markdown(f"## {t('api_keys')}")
+        st.markdown(f"## {opts['api_keys']}")
         keys = dict(st.session_state["api_keys"])
         keys["openai"] = st.text_input("OpenAI API Key", type="password", value=keys.get("openai", ""))
         keys["gemini"] = st.text_input("Gemini API Key", type="password", value=keys.get("gemini", ""))
         st.session_state["api_keys"] = keys
 
 
+TW_REQUIRED_FIELDS = [
+    "e_no", "case_type", "device_category", "origin", "product_class",
+    "name_zh", "name_en", "uniform_id", "firm_name", "firm_addr",
+    "resp_name", "contact_name", "contact_tel", "contact_email",
+    "manu_name", "manu_addr",
+]
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def tw_case_gaps_df(dataset_hash: str, _cases: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Pre-audit file-consistency gaps for every case, computed column-wise over the dataset."""
+    df = pd.DataFrame(list(_cases)).reindex(columns=TW_APP_FIELDS).fillna("").astype(str)
+    df = df.apply(lambda col: col.str.strip())
+    is_import = df["origin"].eq("輸入")
+    gaps = pd.DataFrame({
+        "missing_required": df[TW_REQUIRED_FIELDS].eq("").sum(axis=1),
+        "gap_auth": is_import & df["auth_applicable"].ne("適用"),
+        "gap_cfs": is_import & df["cfs_applicable"].ne("適用"),
+        "gap_qms": df["qms_applicable"].ne("適用"),
+    })
+    gaps["gap_count"] = gaps["missing_required"] + gaps[["gap_auth", "gap_cfs", "gap_qms"]].sum(axis=1)
+    return df[["e_no", "name_zh", "origin"]].join(gaps)
+
 def render_tw_premarket_tab():
     st.markdown("## 第二、三等級醫療器材查驗登記（TW Premarket）")
     
@@ -509,8 +763,19 @@ def render_tw_premarket_tab():
         sel = st.selectbox("Select default dataset", ds_labels)
         if st.button("Load Dataset"):
              key = ds_keys[ds_labels.index(sel)]
-             st.session_state["tw_cases_dataset"] = DEFAULT_CASES[key]["cases"]
+             cases = copy.deepcopy(DEFAULT_CASES[key]["cases"])
+             st.session_state["tw_cases_dataset"] = cases
+             st.session_state["tw_cases_dataset_hash"] = _json_digest(cases)
              st.success("Loaded.")
+
+    cases = st.session_state.get("tw_cases_dataset") or []
+    if cases:
+        # Hashed once when the dataset is loaded; reruns reuse the stored key.
+        cases_hash = st.session_state.get("tw_cases_dataset_hash")
+        if cases_hash is None:
+            cases_hash = st.session_state["tw_cases_dataset_hash"] = _json_digest(cases)
+        st.markdown("#### Pre-audit gaps")
+        st.dataframe(tw_case_gaps_df(cases_hash, cases), use_container_width=True)
              
     st.markdown("### 1) Guidance")
     if not DEFAULT_GUIDES:
@@ -544,7 +809,7 @@ def render_510k_review_tab():
         if DEFAULT_CHK:
             k = st.selectbox("Checklist", list(DEFAULT_CHK.keys()), format_func=lambda x: DEFAULT_CHK[x]["title"])
             if st.button("Load Checklist"):
-                st.session_state["k510_checklist_dataset"] = DEFAULT_CHK[k]["items"]
+                st.session_state["k510_checklist_dataset"] = copy.deepcopy(DEFAULT_CHK[k]["items"])
     with c2:
         if DEFAULT_G_510K:
             k = st.selectbox("Guidance", list(DEFAULT_G_510K.keys()), format_func=lambda x: DEFAULT_G_510K[x]["title"])
@@ -554,24 +819,42 @@ def render_510k_review_tab():
     st.write("Checklist items loaded:", len(st.session_state.get("k510_checklist_dataset", [])))
 
 
+def render_home_tab():
+    st.title("Antigravity AI Workspace")
+    st.write("Welcome. Use the sidebar to reload default datasets.")
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _agents_df(cfg_hash: str, _cfg: Dict[str, Any]) -> pd.DataFrame:
+    """One row per agent; `_cfg` is unhashed by Streamlit, `cfg_hash` is the cache key."""
+    rows = [{"agent_id": aid, **(a if isinstance(a, dict) else {})} for aid, a in (_cfg.get("agents") or {}).items()]
+    return pd.json_normalize(rows)
+
+
+def render_agents_config_tab():
+    cfg = st.session_state["agents_cfg"]
+    # Hashed when the config is written; reruns reuse the stored key.
+    cfg_hash = st.session_state.get("agents_cfg_hash")
+    if cfg_hash is None:
+        cfg_hash = st.session_state["agents_cfg_hash"] = _json_digest(cfg)
+    st.dataframe(_agents_df(cfg_hash, cfg), use_container_width=True)
+    with st.expander("Raw config"):
+        st.write(cfg)
+
+
 # ============================================================
 # Main
 # ============================================================
 render_sidebar()
 apply_style_engine(st.session_state.settings["theme"], st.session_state.settings["painter_style"])
 
-tabs = st.tabs(["Dashboard", "TW Premarket", "510(k) Pipeline", "Agents Config"])
-
-with tabs[0]:
-    st.title("Antigravity AI Workspace")
-    st.write("Welcome. Use the sidebar to reload default datasets.")
-    
-with tabs[1]:
-    render_tw_premarket_tab()
-
-with tabs[2]:
-    render_510k_review_tab()
-
-with tabs[3]:
-    st.write(st.session_state["agents_cfg"])
-```python
+# st.tabs executes every tab body on each rerun and cannot report which tab is visible,
+# so a horizontal radio drives navigation and only the active section is rendered.
+MAIN_TABS = {
+    "Dashboard": render_home_tab,
+    "TW Premarket": render_tw_premarket_tab,
+    "510(k) Pipeline": render_510k_review_tab,
+    "Agents Config": render_agents_config_tab,
+}
+active_tab = st.radio("Section", list(MAIN_TABS), horizontal=True, key="_active_tab", label_visibility="collapsed")
+MAIN_TABS[active_tab]()